@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent key-value cache on the filesystem.
+
+Each entry is pickled into its own file below :data:`CACHEDIR`, named
+after a hash of namespace and key.  Entries are written atomically,
+concurrent ``marv`` processes never see partial entries.  The cache
+may be removed at any time to start from scratch.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+
+CACHEDIR = os.environ.get('MARV_ROBOTICS_CACHEDIR') or \
+           os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                        os.path.expanduser('~/.cache'), 'marv_robotics')
+
+
+def _entry_path(namespace, key):
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+    return os.path.join(CACHEDIR, namespace, digest[:2], digest[2:])
+
+
+def load(namespace, key, default=None):
+    """Return value stored for key or default."""
+    try:
+        with open(_entry_path(namespace, key), 'rb') as f:
+            _key, value = pickle.load(f)
+    except Exception:  # missing, truncated or otherwise unusable
+        return default
+    return value if _key == key else default
+
+
+def store(namespace, key, value):
+    """Store value for key, replacing any previous value."""
+    path = _entry_path(namespace, key)
+    dirpath = os.path.dirname(path)
+    try:
+        os.makedirs(dirpath)
+    except OSError:
+        if not os.path.isdir(dirpath):
+            raise
+    fd, tmppath = tempfile.mkstemp(prefix='.', dir=dirpath)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((key, value), f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+    except:
+        os.unlink(tmppath)
+        raise
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Delegation to sub-generators within marv nodes.
+
+Python 2 lacks ``yield from``, node bodies shared between several
+nodes are run by :func:`trampoline` instead.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import functools
+import sys
+import types
+
+
+def trampoline(func):
+    """Turn generator function into one delegating to sub-generators.
+
+    Whenever the generator yields a generator, the latter is run in
+    its place until exhausted, like with ``yield from``, and None is
+    sent in return.  Values sent and exceptions thrown are passed on
+    to the innermost running generator, exceptions raised by a
+    sub-generator to the one that yielded it.  Closing closes all
+    running generators, innermost first.
+
+    Use below the :func:`marv.input` decorators of a node::
+
+        @marv.node(...)
+        @marv.input(...)
+        @trampoline
+        def node(...):
+            yield _body(...)
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        stack = [func(*args, **kw)]
+        value = None
+        exc_info = None
+        while stack:
+            gen = stack[-1]
+            try:
+                if exc_info is None:
+                    cmd = gen.send(value)
+                else:
+                    cmd = gen.throw(*exc_info)
+            except StopIteration:
+                stack.pop()
+                value = exc_info = None
+                continue
+            except Exception:
+                stack.pop()
+                if not stack:
+                    raise
+                value, exc_info = None, sys.exc_info()
+                continue
+            value = exc_info = None
+            if isinstance(cmd, types.GeneratorType):
+                stack.append(cmd)
+                continue
+            try:
+                value = yield cmd
+            except GeneratorExit:
+                for gen in reversed(stack):
+                    gen.close()
+                raise
+            except Exception:
+                exc_info = sys.exc_info()
+    return wrapper
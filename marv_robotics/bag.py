@@ -18,21 +18,36 @@
 
 from __future__ import absolute_import, division, print_function
 
+import functools
+import heapq
+import inspect
+import math
+import mmap
+import multiprocessing
+import os
 import re
 import sys
+import time
+import types
 from collections import defaultdict, namedtuple
 from itertools import groupby
 from logging import getLogger
+from multiprocessing.pool import ThreadPool
 
 import capnp
+import genmsg
 import genpy
+import genpy.dynamic
 import rosbag
-from rosbag.bag import _get_message_type
+from rosbag.bag import BagMessage, _get_message_type
 
 import marv
 import marv_nodes
 from marv.scanner import DatasetInfo
-from .bag_capnp import Bagmeta, Header, Message
+from . import _cache
+from . import bagfile
+from ._trampoline import trampoline
+from .bag_capnp import Bagmeta, Header, Message, MessageBatch
 
 
 # Regular expression used to aggregate individual bags into sets (see
@@ -151,9 +166,226 @@ def scan(dirpath, dirnames, filenames):
     return datasets
 
 
+SCANCACHE = 'scan'
+SCANCACHE_VERSION = 2  # increase along with changes to cache entries
+
+# Whether directory trees are unchanged, valid within one scan, which
+# is identified by the frame of the caller walking the directories.
+_unchanged_memo = {}
+_scan_caller = [None]
+
+
+def _scan_site():
+    # Whether files are known depends on the database of the site
+    # being scanned, entries are kept separately per database.
+    try:
+        from flask import current_app
+        return current_app.config['SQLALCHEMY_DATABASE_URI']
+    except (ImportError, KeyError, RuntimeError):
+        return None
+
+
+def _dirstat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    # Entries could still be added within the filesystem's mtime
+    # granularity, a directory modified just now is never stable.
+    if stat.st_mtime > time.time() - 1:
+        return None
+    return (stat.st_ino, stat.st_mtime)
+
+
+def _unchanged(site, path):
+    """Whether directory tree below path is unchanged and fully known."""
+    if path in _unchanged_memo:
+        return bool(_unchanged_memo[path])
+    entry = _cache.load(SCANCACHE, (SCANCACHE_VERSION, site, path))
+    if entry is None:
+        rv = False
+    else:
+        dirstat, subdirs, clean = entry
+        rv = (clean and dirstat is not None and dirstat == _dirstat(path) and
+              all(_unchanged(site, os.path.join(path, x)) for x in subdirs))
+    _unchanged_memo[path] = rv
+    return rv
+
+
+def cached_scan(dirpath, dirnames, filenames):
+    """Scanner like :func:`scan` skipping unchanged directory trees
+
+    For each scanned directory its inode, mtime and subdirectories
+    are cached on disk (see :mod:`marv_robotics._cache`), together
+    with whether all of its files are already known to marv, i.e.
+    :func:`scan` did not yield any new datasets.  Traversal into
+    subdirectories whose whole tree is known and unchanged since the
+    last scan is skipped, only directories need to be stat'ed for
+    that.  A rescan thus costs time proportional to what changed
+    instead of the size of the archive.
+
+    Directories with new datasets are traversed again until a scan
+    finds them known, therefore dry runs and scans that fail before
+    committing do not hide datasets.  Known files are recognized by
+    marv not passing them to the scanner, see
+    :meth:`marv.collection.Collection.scan`.  Results for unchanged
+    trees are kept only during one scan, i.e. for calls from the same
+    invocation of the walking function, also for scans of
+    subdirectories.  Entries are kept per site
+    database; outside of a marv application context nothing is
+    skipped.  Files are added and removed by creating new directory
+    entries, which changes the mtime of the containing directory.
+    Files of discarded datasets are not picked up again within
+    unchanged trees, remove the cache directory to force a full scan.
+
+    Use in place of :func:`scan`::
+
+        scanner = marv_robotics.bag:cached_scan
+
+    For arguments and return value see :func:`scan`.
+    """
+    caller = sys._getframe(1)
+    if caller is not _scan_caller[0]:
+        _unchanged_memo.clear()
+        _scan_caller[0] = caller
+    _unchanged_memo[dirpath] = False
+    datasets = scan(dirpath, dirnames, filenames)
+    site = _scan_site()
+    if site is None:
+        return datasets
+    subdirs = list(dirnames)
+    dirnames[:] = [x for x in dirnames
+                   if not _unchanged(site, os.path.join(dirpath, x))]
+    _cache.store(SCANCACHE, (SCANCACHE_VERSION, site, dirpath),
+                 (_dirstat(dirpath), subdirs, not datasets))
+    return datasets
+
+
+def _legacy_nsec(nsec):
+    # Bagmeta timestamps used to be computed via float seconds from
+    # rosbag, keep them identical.
+    return int((nsec // 1000000000 + nsec % 1000000000 / 1e9) * 1.e9)
+
+
+BAGMETA_CACHE = 'bagmeta'
+BAGMETA_CACHE_VERSION = 2  # increase along with changes to Bag records
+
+
+def cached_read_bagmeta(path):
+    """Like :func:`read_bagmeta`, but cached across datasets and runs.
+
+    There is one cache entry per bag file, holding its size, mtime
+    and inode along with the metadata.  Only new or changed bags are
+    actually read, their entry is replaced.
+    """
+    stat = os.stat(path)
+    fingerprint = (BAGMETA_CACHE_VERSION, stat.st_size, stat.st_mtime,
+                   stat.st_ino)
+    entry = _cache.load(BAGMETA_CACHE, path)
+    if entry is not None and entry[0] == fingerprint:
+        return entry[1]
+    bag = read_bagmeta(path)
+    _cache.store(BAGMETA_CACHE, path, (fingerprint, bag))
+    return bag
+
+
+def read_bagmeta(path):
+    """Read meta information of one bag file.
+
+    Bags of format version 2.0 are read with
+    :func:`marv_robotics.bagfile.read_index`, which reads only the
+    index section at the end of the file, and
+    :func:`marv_robotics.bagfile.read_chunk_index` for per-connection
+    statistics, which reads the chunk header and index data of each
+    chunk, skipping message data.  Other bags are read with
+    :class:`rosbag.Bag`.
+
+    Returns:
+        Dictionary according to :class:`.bag_capnp.Bag`.
+    """
+    with open(path, 'rb') as f:
+        try:
+            index = bagfile.read_index(f)
+        except bagfile.Unsupported:
+            return _read_bagmeta_rosbag(path)
+        chunks = [bagfile.read_chunk_index(f, x) for x in index.chunks]
+
+    if index.chunks:
+        start_time = _legacy_nsec(min(x.start_time for x in index.chunks))
+        end_time = _legacy_nsec(max(x.end_time for x in index.chunks))
+    else:
+        start_time = 0
+        end_time = 0
+    stats = bagfile.connection_stats(index.connections, chunks)
+    return _make_bag(index.version, start_time, end_time,
+                     index.connections, index.chunks, stats)
+
+
+def _read_bagmeta_rosbag(path):
+    with rosbag.Bag(path) as bag:
+        try:
+            start_time = int(bag.get_start_time() * 1.e9)
+            end_time = int(bag.get_end_time() * 1.e9)
+        except rosbag.ROSBagException:
+            start_time = 0
+            end_time = 0
+        # Bags not readable by bagfile are of format version 1.2,
+        # their index has no offsets to derive message sizes from;
+        # size 0 flags them as unknown.
+        stats = {conid: bagfile.ConnectionStats(entries[0].time.to_nsec(),
+                                                entries[-1].time.to_nsec(), 0)
+                 for conid, entries in bag._connection_indexes.iteritems()
+                 if entries}
+        return _make_bag(bag.version, start_time, end_time,
+                         bag._connections, bag._chunks, stats)
+
+
+def _frequency(msg_count, start_time, end_time):
+    if msg_count < 2 or end_time <= start_time:
+        return 0.
+    return (msg_count - 1) / (end_time - start_time) * 1e9
+
+
+def _make_bag(version, start_time, end_time, connections, chunks, stats):
+    msg_counts = defaultdict(int)
+    for chunk in chunks:
+        for conid, count in chunk.connection_counts.iteritems():
+            msg_counts[conid] += count
+
+    nostats = bagfile.ConnectionStats(0, 0, 0)
+    _connections = []
+    for con in connections.itervalues():
+        msg_count = msg_counts[con.id]
+        _stats = stats.get(con.id, nostats)
+        _connections.append({
+            'topic': con.topic,
+            'datatype': con.datatype,
+            'md5sum': con.md5sum,
+            'msg_def': con.msg_def,
+            'msg_count': msg_count,
+            'latching': {'0': False,
+                         '1': True}[con.header.get('latching', '0')],
+            'start_time': _stats.start_time,
+            'end_time': _stats.end_time,
+            'frequency': _frequency(msg_count, _stats.start_time,
+                                    _stats.end_time),
+            'size': _stats.size,
+        })
+
+    return {
+        'start_time': start_time,
+        'end_time': end_time,
+        'duration': end_time - start_time,
+        'msg_count': sum(msg_counts.itervalues()),
+        'connections': _connections,
+        'version': version,
+    }
+
+
 @marv.node(Bagmeta)
 @marv.input('dataset', marv_nodes.dataset)
-def bagmeta(dataset):
+@marv.input('workers', default=4)
+def bagmeta(dataset, workers):
     """Extract meta information from bag file.
 
     In case of multiple connections for one topic, they are assumed to
@@ -161,62 +393,60 @@ def bagmeta(dataset):
 
     A topic's message type and latching mode, and a message type's
     md5sum are assumed not to change across split bags.
+
+    Meta information of individual bags is cached (see
+    :func:`cached_read_bagmeta`), for sets gaining bags only the new
+    ones are read.
+
+    Args:
+        workers (int): Number of threads reading bags of a set in
+            parallel.  The output does not depend on it.
     """
     dataset = yield marv.pull(dataset)
     paths = [x.path for x in dataset.files if x.path.endswith('.bag')]
 
-    bags = []
+    # Reading is dominated by I/O, threads release the GIL meanwhile
+    if workers > 1 and len(paths) > 1:
+        pool = ThreadPool(min(workers, len(paths)))
+        try:
+            bags = pool.map(cached_read_bagmeta, paths)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        bags = [cached_read_bagmeta(path) for path in paths]
+
     start_time = sys.maxint
     end_time = 0
     connections = {}
-    for path in paths:
-        with rosbag.Bag(path) as bag:
-            try:
-                _start_time = int(bag.get_start_time() * 1.e9)
-                _end_time = int(bag.get_end_time() * 1.e9)
-            except rosbag.ROSBagException:
-                _start_time = sys.maxint
-                _end_time = 0
-
-            start_time = _start_time if _start_time < start_time else start_time
-            end_time = _end_time if _end_time > end_time else end_time
-
-            _msg_counts = defaultdict(int)
-            for chunk in bag._chunks:
-                for conid, count in chunk.connection_counts.iteritems():
-                    _msg_counts[conid] += count
-
-            _connections = [
-                {'topic': x.topic,
-                 'datatype': x.datatype,
-                 'md5sum': x.md5sum,
-                 'msg_def': x.msg_def,
-                 'msg_count': _msg_counts[x.id],
-                 'latching': {'0': False, '1': True}[x.header.get('latching', '0')]}
-                for x in bag._connections.itervalues()
-            ]
-
-            _start_time = _start_time if _start_time != sys.maxint else 0
-            bags.append({
-                'start_time': _start_time,
-                'end_time': _end_time,
-                'duration': _end_time - _start_time,
-                'msg_count': sum(_msg_counts.itervalues()),
-                'connections': _connections,
-                'version': bag.version,
-            })
-
-            for _con in _connections:
-                key = (_con['topic'], _con['datatype'], _con['md5sum'])
-                con = connections.get(key)
-                if con:
-                    con['msg_count'] += _con['msg_count']
-                    con['latching'] = con['latching'] or _con['latching']
-                else:
-                    connections[key] = _con.copy()
+    for bag in bags:
+        # Empty bags have neither start nor end time
+        if bag['end_time']:
+            start_time = min(start_time, bag['start_time'])
+            end_time = max(end_time, bag['end_time'])
+
+        for _con in bag['connections']:
+            key = (_con['topic'], _con['datatype'], _con['md5sum'])
+            con = connections.get(key)
+            if con:
+                if _con['msg_count'] and con['msg_count']:
+                    con['start_time'] = min(con['start_time'],
+                                            _con['start_time'])
+                    con['end_time'] = max(con['end_time'], _con['end_time'])
+                elif _con['msg_count']:
+                    con['start_time'] = _con['start_time']
+                    con['end_time'] = _con['end_time']
+                con['msg_count'] += _con['msg_count']
+                con['latching'] = con['latching'] or _con['latching']
+                con['size'] += _con['size']
+            else:
+                connections[key] = _con.copy()
 
     connections = sorted(connections.values(),
                          key=lambda x: (x['topic'], x['datatype'], x['md5sum']))
+    for con in connections:
+        con['frequency'] = _frequency(con['msg_count'], con['start_time'],
+                                      con['end_time'])
     start_time = start_time if start_time != sys.maxint else 0
     yield marv.push({
         'start_time': start_time,
@@ -230,92 +460,661 @@ def bagmeta(dataset):
     })
 
 
-def read_messages(paths, topics=None, start_time=None, end_time=None):
-    """Iterate chronologically raw BagMessage for topic from paths."""
-    bags = {path: rosbag.Bag(path) for path in paths}
-    gens = {path: bag.read_messages(topics=topics, start_time=start_time,
-                                    end_time=end_time, raw=True)
-            for path, bag in bags.items()}
-    msgs = {}
-    prev_timestamp = genpy.Time(0)
-    while True:
-        for key in (gens.viewkeys() - msgs.viewkeys()):
+def _time_range(path):
+    """Return exact (start, end) nanoseconds of bag or None if unknown."""
+    try:
+        with open(path, 'rb') as f:
+            index = bagfile.read_index(f)
+    except bagfile.Unsupported:
+        return None
+    if not index.chunks:
+        return (sys.maxint, 0)
+    return (min(x.start_time for x in index.chunks),
+            max(x.end_time for x in index.chunks))
+
+
+def _rosbag_messages(path, topics, start_time, end_time):
+    with rosbag.Bag(path) as bag:
+        for msg in bag.read_messages(topics=topics, start_time=start_time,
+                                     end_time=end_time, raw=True):
+            yield msg
+
+
+def _chunkscan_messages(path, topics, start_time, end_time, chunks=None,
+                        pool=None):
+    with open(path, 'rb') as f:
+        try:
+            index = bagfile.read_index(f)
+        except bagfile.Unsupported:
+            index = None
+        if index is not None:
+            connections = {conid: con
+                           for conid, con in index.connections.iteritems()
+                           if topics is None or con.topic in topics}
+            pytypes = {}
+            # Buffers handed out keep the mapping alive beyond the file
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            msgs = bagfile.read_messages(
+                mapped, index, set(connections),
+                start_time=(start_time.to_nsec()
+                            if start_time is not None else 0),
+                end_time=(end_time.to_nsec()
+                          if end_time is not None else sys.maxint),
+                positions=chunks.get(path, ()) if chunks is not None else None,
+                pool=pool)
+            for conid, timestamp, data, pos in msgs:
+                con = connections[conid]
+                pytype = pytypes.get(conid)
+                if pytype is None:
+                    pytype = pytypes[conid] = _message_type(con)
+                raw = (con.datatype, data, con.md5sum, pos, pytype)
+                yield BagMessage(con.topic, raw,
+                                 genpy.Time(*divmod(timestamp, 1000000000)))
+    if index is None:
+        for msg in _rosbag_messages(path, topics, start_time, end_time):
+            yield msg
+
+
+class _LazyThreadPool(object):
+    """ThreadPool started on first use, e.g. for compressed chunks only."""
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = None
+
+    def apply_async(self, func, args=()):
+        if self.pool is None:
+            self.pool = ThreadPool(self.processes)
+        return self.pool.apply_async(func, args)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def read_messages(paths, topics=None, start_time=None, end_time=None,
+                  chunkscan=False, workers=1, chunks=None):
+    """Iterate chronologically raw BagMessage for topic from paths.
+
+    Messages of all bags are merged with a heap.  Bags are opened only
+    once their first message might be next and closed as soon as they
+    are exhausted, for sets of split bags typically only one or two
+    bags are open at any time.  Messages with identical timestamps are
+    yielded in order of paths.
+
+    With chunkscan, bags are read chunk by chunk in file order with
+    :func:`bagfile.read_messages` instead of along their index with
+    :class:`rosbag.Bag`.  Each chunk is decompressed once, instead of
+    once per message of interleaving topics.  Bags not supported by
+    :mod:`bagfile` are read with :class:`rosbag.Bag` anyway.
+
+    In chunkscan mode, bags are mapped into memory and message data
+    are read-only buffers, for uncompressed chunks pointing directly
+    into the mapped file.
+
+    In chunkscan mode with more than one worker, compressed chunks
+    are read ahead and decompressed by a pool of worker threads,
+    within the memory budget of :data:`bagfile.READAHEAD`.  The pool
+    is started only once a compressed chunk is encountered.
+
+    In chunkscan mode, chunks may be a dictionary mapping paths to
+    sets of positions of chunks to read exclusively, e.g. for
+    sampling messages planned with the bag index.  Other messages may
+    be yielded as well.
+    """
+    pool = _LazyThreadPool(workers) if chunkscan and workers > 1 else None
+    if chunkscan:
+        reader = functools.partial(_chunkscan_messages, chunks=chunks,
+                                   pool=pool)
+    else:
+        reader = _rosbag_messages
+    _start = start_time.to_nsec() if start_time is not None else 0
+    _end = end_time.to_nsec() if end_time is not None else sys.maxint
+
+    # Entries are (timestamp, idx, msg) with msg being None for bags
+    # not yet opened; each bag has at most one entry.
+    heap = []
+    for idx, path in enumerate(paths):
+        timerange = _time_range(path)
+        if timerange is None:
+            heap.append((0, idx, None))
+        elif timerange[0] <= _end and timerange[1] >= _start:
+            heap.append((max(timerange[0], _start), idx, None))
+    heapq.heapify(heap)
+
+    gens = {}
+    try:
+        prev_timestamp = 0
+        while heap:
+            timestamp, idx, msg = heapq.heappop(heap)
+            if msg is not None:
+                assert timestamp >= prev_timestamp
+                yield msg
+                prev_timestamp = timestamp
+            else:
+                gens[idx] = reader(paths[idx], topics, start_time, end_time)
             try:
-                msgs[key] = gens[key].next()
+                msg = next(gens[idx])
             except StopIteration:
-                bags[key].close()
-                del bags[key]
-                del gens[key]
-        if not msgs:
-            break
-        next_key = reduce(lambda x, y: x if x[1].timestamp < y[1].timestamp else y,
-                          msgs.items())[0]
-        next_msg = msgs.pop(next_key)
-        assert next_msg.timestamp >= prev_timestamp
-        yield next_msg
-        prev_timestamp = next_msg.timestamp
+                del gens[idx]
+                continue
+            heapq.heappush(heap, (msg.timestamp.to_nsec(), idx, msg))
+    finally:
+        for gen in gens.values():
+            gen.close()
+        if pool is not None:
+            pool.close()
 
 
-@marv.node(Message, Header, group='ondemand')
-@marv.input('dataset', marv_nodes.dataset)
-@marv.input('bagmeta', bagmeta)
-def raw_messages(dataset, bagmeta):
-    """Stream messages from a set of bag files."""
+Selector = namedtuple('Selector', 'topic msg_type start_time end_time '
+                      'every count interval')
+_SELECTOR_PARAMS = {'start': 'start_time', 'end': 'end_time', 'every': 'every',
+                    'count': 'count', 'interval': 'interval'}
+
+
+def parse_selector(name):
+    """Parse name of a requested message stream.
+
+    Names are either a topic, or a ``topic:type`` selector for a group
+    of streams with ``*`` matching any topic or type.  Alternative
+    types are separated by comma, e.g.
+    ``*:sensor_msgs/Image,sensor_msgs/CompressedImage``.  Both kinds
+    of names may be followed by query parameters, e.g. ``/foo?start=10&end=20``:
+
+    start, end
+        Inclusive timestamps in nanoseconds restricting streams to a
+        time window.  Either may be omitted.
+
+    every
+        Sample every Nth message, starting with the first.
+
+    count
+        Sample at most N messages, equidistantly spread by index;
+        like ``every`` with N chosen to yield up to count messages.
+
+    interval
+        Sample one message per interval of nanoseconds, namely the
+        first one of each interval, starting with the first message.
+
+    Returns:
+        :class:`Selector` with msg_type being None for plain topics,
+        and fields of omitted query parameters being None.
+
+    Raises:
+        ValueError: The name contains invalid query parameters or
+            more than one way of sampling.
+    """
+    name, _, query = name.partition('?')
+    params = dict.fromkeys(_SELECTOR_PARAMS.values())
+    for param in query.split('&') if query else []:
+        key, sep, value = param.partition('=')
+        if not sep or key not in _SELECTOR_PARAMS:
+            raise ValueError('Invalid parameter {!r} in {!r}'
+                             .format(param, name))
+        params[_SELECTOR_PARAMS[key]] = int(value)
+    sampling = [x for x in ('every', 'count', 'interval')
+                if params[x] is not None]
+    if len(sampling) > 1:
+        raise ValueError('Conflicting parameters {} in {!r}'
+                         .format(sampling, name))
+    if any(params[x] is not None and params[x] < 1 for x in sampling):
+        raise ValueError('Sampling parameter needs to be positive in {!r}'
+                         .format(name))
+    topic, _, msg_type = name.partition(':')
+    return Selector(topic=topic, msg_type=msg_type or None, **params)
+
+
+def _index_entries(path, topics, start_time, end_time):
+    """Return list of (time, position) of messages of topics in window.
+
+    Positions are those of raw messages read by :func:`read_messages`,
+    (chunk_pos, offset) for bags of format version 2.0, and the offset
+    for bags of format version 1.2.
+    """
+    with open(path, 'rb') as f:
+        try:
+            index = bagfile.read_index(f)
+        except bagfile.Unsupported:
+            index = None
+        if index is not None:
+            conids = {conid for conid, con in index.connections.iteritems()
+                      if con.topic in topics}
+            entries = []
+            for info in index.chunks:
+                if info.end_time < start_time or info.start_time > end_time or \
+                   conids.isdisjoint(info.connection_counts):
+                    continue
+                chunk = bagfile.read_chunk_index(f, info)
+                entries.extend((time, (info.pos, offset))
+                               for conid, _entries in chunk.entries.iteritems()
+                               if conid in conids
+                               for time, offset in _entries
+                               if start_time <= time <= end_time)
+            return sorted(entries)
+
+    with rosbag.Bag(path) as bag:
+        connections = list(bag._get_connections(topics, None))
+        entries = bag._get_entries(connections, _to_time(start_time),
+                                   _to_time(end_time))
+        return sorted((x.time.to_nsec(), x.position) for x in entries)
+
+
+def _sample(paths, topic, selector, start_time, end_time):
+    """Plan sampling of topic according to selector using bag indexes.
+
+    Returns:
+        List of (timestamp, position) of messages to sample,
+        identifying them also among messages with equal timestamps,
+        dictionary mapping paths to sets of positions of chunks
+        containing them, for bags of format version 2.0, and the step
+        between indexes of sampled messages, None for intervals.
+    """
+    entries = sorted((time, idx, pos) for idx, path in enumerate(paths)
+                     for time, pos in _index_entries(path, [topic], start_time,
+                                                     end_time))
+    every = None
+    if selector.interval is not None and entries:
+        first = entries[0][0]
+        buckets = groupby(entries,
+                          key=lambda x: (x[0] - first) // selector.interval)
+        entries = [next(group) for _, group in buckets]
+    elif selector.count is not None:
+        every = max(1, int(math.ceil(len(entries) / selector.count)))
+        entries = entries[::every]
+    elif selector.every is not None:
+        every = selector.every
+        entries = entries[::every]
+
+    chunks = defaultdict(set)
+    for _, idx, pos in entries:
+        if isinstance(pos, tuple):
+            chunks[paths[idx]].add(pos[0])
+    return [(time, pos) for time, _, pos in entries], chunks, every
+
+
+def segment_times(paths, topic, segments, start_time=0, end_time=sys.maxint,
+                  align=1):
+    """Split messages of topic into time segments using bag indexes.
+
+    Args:
+        paths (list): Paths of bag files.
+        topic (str): Topic whose messages are split.
+        segments (int): Maximum number of segments.
+        start_time (int): Inclusive start of window in nanoseconds.
+        end_time (int): Inclusive end of window in nanoseconds.
+        align (int): Segments start at multiples of align messages,
+            e.g. to keep keyframe intervals of videos.
+
+    Returns:
+        List of inclusive (start_time, end_time) tuples of consecutive
+        segments with about the same number of messages each.
+        Messages with identical timestamps end up in the same segment,
+        therefore fewer segments might be returned.
+    """
+    times = sorted(time for path in paths
+                   for time, _ in _index_entries(path, [topic], start_time,
+                                                 end_time))
+    if not times:
+        return []
+    starts = sorted({times[idx * len(times) // segments // align * align]
+                     for idx in range(segments)})
+    ends = [x - 1 for x in starts[1:]] + [times[-1]]
+    return zip(starts, ends)
+
+
+def _to_time(nsec):
+    return genpy.Time(*divmod(nsec, 1000000000)) if nsec is not None else None
+
+
+def _window_index(paths, topics, start_time, end_time):
+    """Count messages per topic within time window using chunk indexes.
+
+    Chunks entirely within the window are counted from their chunk
+    info, only chunks crossing a window boundary have their index
+    data read.
+
+    Returns:
+        Dictionary mapping topics to message counts, None for bags
+        not supported by :mod:`bagfile`, and dictionary mapping paths
+        to sets of positions of chunks with messages in the window.
+    """
+    counts = defaultdict(int)
+    chunks = defaultdict(set)
+    for path in paths:
+        with open(path, 'rb') as f:
+            try:
+                index = bagfile.read_index(f)
+            except bagfile.Unsupported:
+                counts = None
+                continue
+            contopics = {conid: con.topic
+                         for conid, con in index.connections.iteritems()
+                         if con.topic in topics}
+            for info in index.chunks:
+                if info.end_time < start_time or info.start_time > end_time or \
+                   contopics.viewkeys().isdisjoint(info.connection_counts):
+                    continue
+                if start_time <= info.start_time and info.end_time <= end_time:
+                    chunks[path].add(info.pos)
+                    if counts is not None:
+                        for conid, count in info.connection_counts.iteritems():
+                            if conid in contopics:
+                                counts[contopics[conid]] += count
+                    continue
+                chunk = bagfile.read_chunk_index(f, info)
+                for conid, entries in chunk.entries.iteritems():
+                    if conid not in contopics:
+                        continue
+                    count = sum(1 for x in entries
+                                if start_time <= x[0] <= end_time)
+                    if count:
+                        chunks[path].add(info.pos)
+                    if counts is not None:
+                        counts[contopics[conid]] += count
+    return counts, chunks
+
+
+# Batches are emitted once reaching either limit
+BATCH_SIZE = 1000
+BATCH_BYTES = 1024 * 1024
+
+
+def _raw_messages(dataset, bagmeta, batched=False, multiplexed=False):
+    """Body of raw_messages, raw_message_batches and multiplexed_messages."""
     bagmeta, dataset = yield marv.pull_all(bagmeta, dataset)
     bagtopics = bagmeta.topics
     connections = bagmeta.connections
     paths = [x.path for x in dataset.files if x.path.endswith('.bag')]
     requested = yield marv.get_requested()
-    log = yield marv.get_logger()
 
     alltopics = set()
     bytopic = defaultdict(list)
     groups = {}
+    windows = []
+    chunks = defaultdict(set)
+    readall = False
     for name in [x.name for x in requested]:
-        if ':' in name:
-            reqtop, reqtype = name.split(':')
+        selector = parse_selector(name)
+        if selector.msg_type:
             # BUG: topic with more than one type is not supported
+            msg_types = selector.msg_type.split(',')
             topics = [con.topic for con in connections
-                      if ((reqtop == '*' or reqtop == con.topic) and
-                          (reqtype == '*' or reqtype == con.datatype))]
+                      if (selector.topic in ('*', con.topic) and
+                          ('*' in msg_types or con.datatype in msg_types))]
+        else:
+            topics = [selector.topic] if selector.topic in bagtopics else []
+        if selector.msg_type and not multiplexed:
             group = groups[name] = yield marv.create_group(name)
             create_stream = group.create_stream
         else:
-            topics = [name] if name in bagtopics else []
             group = None
             create_stream = marv.create_stream
 
+        start_time = selector.start_time or 0
+        end_time = selector.end_time
+        if end_time is None:
+            end_time = sys.maxint
+        windowed = (selector.start_time is not None or
+                    selector.end_time is not None)
+        sampled = any(x is not None for x in (selector.every, selector.count,
+                                              selector.interval))
+        if windowed and not sampled and topics:
+            counts, _chunks = _window_index(paths, topics, start_time, end_time)
+            for path, positions in _chunks.iteritems():
+                chunks[path].update(positions)
+        elif not sampled and topics:
+            readall = True
+        muxed = []
         for topic in topics:
             # BUG: topic with more than one type is not supported
             con = next(x for x in connections if x.topic == topic)
-            # TODO: start/end_time per topic?
-            header = {'start_time': bagmeta.start_time,
-                      'end_time': bagmeta.end_time,
+            # Clamped to the topic, also for windows not overlapping it
+            _start = min(max(con.start_time, start_time), con.end_time)
+            header = {'start_time': _start,
+                      'end_time': max(min(con.end_time, end_time), _start),
                       'msg_count': con.msg_count,
                       'msg_type': con.datatype,
                       'msg_type_def': con.msg_def,
                       'msg_type_md5sum': con.md5sum,
                       'topic': topic}
-            stream = yield create_stream(topic, **header)
-            bytopic[topic].append(stream)
+            if sampled:
+                sample, _chunks, every = _sample(paths, topic, selector,
+                                                 start_time, end_time)
+                for path, positions in _chunks.iteritems():
+                    chunks[path].update(positions)
+                header['msg_count'] = len(sample)
+                if every is not None:
+                    header['every'] = every
+                if sample:
+                    header['start_time'] = sample[0][0]
+                    header['end_time'] = sample[-1][0]
+                sample = set(sample)
+            else:
+                sample = None
+                if windowed and counts is not None:
+                    header['msg_count'] = counts[topic]
+            if multiplexed:
+                muxed.append((topic, sample, {
+                    'name': topic,
+                    'msg_count': header['msg_count'],
+                    'msg_type': con.datatype,
+                    'msg_type_def': con.msg_def,
+                    'msg_type_md5sum': con.md5sum,
+                    'latching': con.latching,
+                }, (header['start_time'], header['end_time'])))
+                continue
+            stream = yield create_stream(topic if group else name, **header)
+            bytopic[topic].append((stream, start_time, end_time, sample, 0))
+
+        if muxed:
+            msg_types = {(x['msg_type'], x['msg_type_md5sum']): x
+                         for _, _, x, _ in muxed}
+            # Time range spans topics with messages, if any
+            spans = [span for _, _, x, span in muxed if x['msg_count']] or \
+                [span for _, _, _, span in muxed]
+            header = {'start_time': min(x[0] for x in spans),
+                      'end_time': max(x[1] for x in spans),
+                      'msg_count': sum(x['msg_count'] for _, _, x, _ in muxed),
+                      'msg_types': [{'name': x['msg_type'],
+                                     'md5sum': x['msg_type_md5sum'],
+                                     'msg_def': x['msg_type_def']}
+                                    for _, x in sorted(msg_types.items())],
+                      'topics': [x for _, _, x, _ in muxed]}
+            stream = yield create_stream(name, **header)
+            for tidx, (topic, sample, _, _) in enumerate(muxed):
+                bytopic[topic].append((stream, start_time, end_time, sample,
+                                       tidx))
         alltopics.update(topics)
+        if topics:
+            windows.append((selector.start_time, selector.end_time))
         if group:
             yield group.finish()
 
     if not alltopics:
         return
 
+    # Read only chunks of requested windows and sampled messages,
+    # messages between them are skipped by chunk.  The overall time
+    # range is the hull of all windows.
+    starts, ends = zip(*windows)
+    start_time = None if None in starts else min(starts)
+    end_time = None if None in ends else max(ends)
+    chunks = None if readall else chunks
+
     # BUG: topic with more than one type is not supported
-    for topic, raw, t in read_messages(paths, topics=list(alltopics)):
-        dct = {'data': raw[1], 'timestamp': t.to_nsec()}
-        for stream in bytopic[topic]:
-            yield stream.msg(dct)
+    msgs = read_messages(paths, topics=list(alltopics),
+                         start_time=_to_time(start_time),
+                         end_time=_to_time(end_time),
+                         chunkscan=True, workers=multiprocessing.cpu_count(),
+                         chunks=chunks)
+    batches = defaultdict(list)
+    batchbytes = defaultdict(int)
+    for topic, raw, t in msgs:
+        timestamp = t.to_nsec()
+        # Message data is copied once, from the mapped bag into capnp
+        dct = {'data': bytes(raw[1]), 'timestamp': timestamp}
+        for stream, start_time, end_time, sample, tidx in bytopic[topic]:
+            if sample is not None:
+                # Positions tell apart equal timestamps
+                if (timestamp, raw[3]) not in sample:
+                    continue
+            elif not start_time <= timestamp <= end_time:
+                continue
+
+            if multiplexed:
+                yield stream.msg(dict(dct, tidx=tidx))
+                continue
+            if not batched:
+                yield stream.msg(dct)
+                continue
+            batch = batches[stream]
+            batch.append(dct)
+            batchbytes[stream] += len(dct['data'])
+            if len(batch) >= BATCH_SIZE or batchbytes[stream] >= BATCH_BYTES:
+                yield stream.msg({'messages': batch})
+                del batches[stream]
+                del batchbytes[stream]
+
+    for streams in bytopic.itervalues():
+        for stream, _, _, _, _ in streams:
+            if batches.get(stream):
+                yield stream.msg({'messages': batches.pop(stream)})
+
+
+@marv.node(Message, Header, group='ondemand')
+@marv.input('dataset', marv_nodes.dataset)
+@marv.input('bagmeta', bagmeta)
+@trampoline
+def raw_messages(dataset, bagmeta):
+    """Stream messages from a set of bag files.
+
+    Streams are requested by name, see :func:`parse_selector`.  For
+    requests restricted to a time window, chunks of the bags outside
+    of all requested windows are not read.  Sampled streams are
+    planned using the bag index; if all requested streams are
+    sampled, only chunks containing sampled messages are read.
+    Headers of streams sampled by every or count carry the step
+    between indexes of sampled messages as ``every``.
+    """
+    yield _raw_messages(dataset, bagmeta)
+
+
+@marv.node(MessageBatch, Header, group='ondemand')
+@marv.input('dataset', marv_nodes.dataset)
+@marv.input('bagmeta', bagmeta)
+@trampoline
+def raw_message_batches(dataset, bagmeta):
+    """Stream batches of messages from a set of bag files.
+
+    Like :func:`raw_messages`, but each message of a stream is a
+    batch of up to :data:`BATCH_SIZE` messages of up to
+    :data:`BATCH_BYTES` total size, reducing the per message overhead
+    for consumers of high-rate topics.  Stream headers are the same,
+    i.e. msg_count is the number of messages, not batches.
+
+    Each of :func:`raw_messages`, :func:`raw_message_batches` and
+    :func:`multiplexed_messages` reads the bags on its own.  Nodes
+    consuming a topic via more than one of them cause it to be read
+    more than once; use the same one for all topics of a dataset.
+    The nodes of this package use :func:`raw_messages`, batching
+    within nodes with :func:`pull_batch`.
+    """
+    yield _raw_messages(dataset, bagmeta, batched=True)
+
+
+@marv.node(Message, Header, group='ondemand')
+@marv.input('dataset', marv_nodes.dataset)
+@marv.input('bagmeta', bagmeta)
+@trampoline
+def multiplexed_messages(dataset, bagmeta):
+    """Stream messages of many topics multiplexed into one stream.
+
+    Requests are like for :func:`raw_messages`, but instead of a group
+    of streams per ``topic:type`` selector, one stream with messages
+    of all selected topics in chronological order is created.  The
+    stream header lists the topics, each message's tidx refers to the
+    topic it belongs to; start_time, end_time and msg_count span all
+    topics like for a single topic.  For consumers of many topics, e.g. ``*:*``,
+    this saves the overhead of one stream per topic.
+    """
+    yield _raw_messages(dataset, bagmeta, multiplexed=True)
+
 
 messages = raw_messages
+message_batches = raw_message_batches
+
+
+def pull_batch(stream, batch, size=BATCH_SIZE):
+    """Pull data of up to size messages of stream into list batch.
+
+    Sub-generator for node bodies run by :func:`trampoline`, batching
+    messages of :func:`messages` for consumers decoding them
+    together, without reading the bags once more like
+    :func:`message_batches` would.  A batch shorter than size marks the
+    end of the stream, which must not be pulled from anymore::
+
+        full = True
+        while full:
+            batch = []
+            yield pull_batch(stream, batch)
+            full = len(batch) == BATCH_SIZE
+            if not batch:
+                break
+    """
+    for _ in range(size):
+        msg = yield marv.pull(stream)
+        if msg is None:
+            break
+        batch.append(msg.data)
 
 
 _ConnectionInfo = namedtuple('_ConnectionInfo', 'md5sum datatype msg_def')
 
+MSGTYPE_CACHE = 'msgtypes'
+_message_types = {}
+
+
+def _exec_message_source(datatype, source):
+    modname = '_marv_msg_{}'.format(datatype.replace('/', '__'))
+    module = types.ModuleType(str(modname))
+    exec(compile(source, '<{}>'.format(datatype), 'exec'), module.__dict__)
+    pkg, name = genmsg.package_resource_name(datatype)
+    return getattr(module, genpy.dynamic._gen_dyn_name(pkg, name))
+
+
+def _message_type(info):
+    """Return generated ROS message class for connection info.
+
+    Classes are memoized in-process, and the Python source generated
+    by genpy is stored persistently by md5sum.  A fresh process thus
+    only compiles the source instead of parsing message definitions
+    and generating code again.
+    """
+    pytype = _message_types.get(info.md5sum)
+    if pytype is not None:
+        return pytype
+
+    key = (info.datatype, info.md5sum)
+    source = _cache.load(MSGTYPE_CACHE, key)
+    if source is not None:
+        try:
+            pytype = _exec_message_source(info.datatype, source)
+        except Exception:
+            getLogger(__name__).warn('Ignoring broken cache entry for %s',
+                                     info.datatype, exc_info=True)
+    if pytype is None:
+        pytype = _get_message_type(info)
+        try:
+            source = inspect.getsource(inspect.getmodule(pytype))
+        except (IOError, TypeError):
+            pass
+        else:
+            _cache.store(MSGTYPE_CACHE, key, source)
+    _message_types[info.md5sum] = pytype
+    return pytype
+
+
 def get_message_type(stream):
     """ROS message type from definition stored for stream."""
     assert stream.msg_type
@@ -324,4 +1123,4 @@ def get_message_type(stream):
     info = _ConnectionInfo(md5sum=stream.msg_type_md5sum,
                            datatype=stream.msg_type,
                            msg_def=stream.msg_type_def)
-    return _get_message_type(info)
+    return _message_type(info)
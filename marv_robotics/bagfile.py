@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight reader for ROS bag files of format version 2.0.
+
+In contrast to :class:`rosbag.Bag`, which reads the index data of
+every chunk upon opening a bag, only the records needed for the task
+at hand are read.  For meta information these are the bag header and
+the connection and chunk info records at the end of the file.
+
+Timestamps are integer nanoseconds.  Offsets of messages are relative
+to the start of the uncompressed chunk data.
+
+Instead of a file object, functions reading chunks accept an
+:class:`mmap.mmap` of the bag file as well.  Data of uncompressed
+chunks and the messages therein are then read-only buffers into the
+mapped file instead of copies.
+
+See http://wiki.ros.org/Bags/Format/2.0
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import bz2
+import heapq
+import mmap
+import struct
+import sys
+from collections import deque, namedtuple
+
+try:
+    import roslz4
+except ImportError:
+    roslz4 = None
+
+try:
+    _buffer = buffer
+except NameError:
+    def _buffer(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+MAGIC = b'#ROSBAG V2.0\n'
+
+OP_MSG_DATA = 0x02
+OP_BAG_HEADER = 0x03
+OP_INDEX_DATA = 0x04
+OP_CHUNK = 0x05
+OP_CHUNK_INFO = 0x06
+OP_CONNECTION = 0x07
+
+UINT32 = struct.Struct('<I')
+UINT64 = struct.Struct('<Q')
+TIME = struct.Struct('<II')
+CONNECTION_COUNT = struct.Struct('<II')
+
+
+class Unsupported(Exception):
+    """Bag file cannot be read by this module, use rosbag instead."""
+
+
+class CorruptBag(Exception):
+    pass
+
+
+Bagindex = namedtuple('Bagindex', 'version connections chunks')
+Connection = namedtuple('Connection', 'id topic datatype md5sum msg_def header')
+ChunkInfo = namedtuple('ChunkInfo', 'pos start_time end_time connection_counts')
+Chunk = namedtuple('Chunk', 'info compression size data_pos data_len entries')
+ConnectionStats = namedtuple('ConnectionStats', 'start_time end_time size')
+RawMessage = namedtuple('RawMessage', 'conid time data pos')
+
+INDEX_ENTRY = struct.Struct('<III')
+
+# Message data records consist of header length, the header fields op,
+# conn and time, and data length, followed by the serialized message.
+MSG_RECORD_OVERHEAD = 4 + (4 + 4) + (4 + 9) + (4 + 13) + 4
+
+# Index data records consist of header length, the header fields op,
+# ver, conn and count, and data length, followed by the entries.
+INDEX_RECORD_OVERHEAD = 4 + (4 + 4) + (4 + 8) + (4 + 9) + (4 + 10) + 4
+
+# Default memory budget in bytes for chunks read ahead
+READAHEAD = 64 * 1024 * 1024
+
+
+def to_nsec(secs, nsecs):
+    return secs * 1000000000 + nsecs
+
+
+def parse_header(buf, start=0, end=None):
+    """Parse header fields of buf[start:end] into dictionary."""
+    end = len(buf) if end is None else end
+    fields = {}
+    pos = start
+    while pos < end:
+        size, = UINT32.unpack_from(buf, pos)
+        pos += 4
+        if pos + size > end:
+            raise CorruptBag('Header field exceeds header')
+        name, sep, value = bytes(buf[pos:pos + size]).partition(b'=')
+        if not sep:
+            raise CorruptBag('Header field without name')
+        fields[name] = value
+        pos += size
+    return fields
+
+
+def iter_records(buf, start=0, end=None):
+    """Iterate (header, data_start, data_end) of records within buf."""
+    end = len(buf) if end is None else end
+    pos = start
+    while pos < end:
+        size, = UINT32.unpack_from(buf, pos)
+        header = parse_header(buf, pos + 4, pos + 4 + size)
+        pos += 4 + size
+        size, = UINT32.unpack_from(buf, pos)
+        pos += 4
+        if pos + size > end:
+            raise CorruptBag('Record data exceeds buffer')
+        yield header, pos, pos + size
+        pos += size
+
+
+def read_record(f):
+    """Read record at current position of file f."""
+    size, = UINT32.unpack(f.read(4))
+    header = parse_header(f.read(size))
+    size, = UINT32.unpack(f.read(4))
+    return header, f.read(size)
+
+
+def _op(header):
+    return ord(header[b'op'])
+
+
+def read_index(f):
+    """Read connections and chunk infos of bag file object f.
+
+    Besides the bag header, only the index section at the end of the
+    file is read, with one large read.
+
+    Returns:
+        :class:`Bagindex` with a dictionary mapping connection ids
+        to :class:`Connection` instances in file order and a list of
+        :class:`ChunkInfo` instances.
+
+    Raises:
+        Unsupported: The bag has a different version or is not
+            indexed, i.e. has not been closed properly.
+    """
+    f.seek(0)
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise Unsupported('Not a ROS bag of version 2.0: {!r}'.format(magic))
+
+    header, _ = read_record(f)
+    if _op(header) != OP_BAG_HEADER:
+        raise CorruptBag('Expected bag header record')
+    index_pos, = UINT64.unpack(header[b'index_pos'])
+    if not index_pos:
+        raise Unsupported('Bag is not indexed')
+
+    f.seek(index_pos)
+    buf = f.read()
+    connections = {}
+    chunks = []
+    for header, start, end in iter_records(buf):
+        op = _op(header)
+        if op == OP_CONNECTION:
+            conid, = UINT32.unpack(header[b'conn'])
+            conhdr = parse_header(buf, start, end)
+            connections[conid] = Connection(
+                id=conid,
+                topic=header[b'topic'],
+                datatype=conhdr[b'type'],
+                md5sum=conhdr[b'md5sum'],
+                msg_def=conhdr[b'message_definition'],
+                header=conhdr)
+        elif op == OP_CHUNK_INFO:
+            ver, = UINT32.unpack(header[b'ver'])
+            if ver != 1:
+                raise Unsupported('Chunk info version {}'.format(ver))
+            connection_counts = {}
+            for pos in range(start, end, CONNECTION_COUNT.size):
+                conid, count = CONNECTION_COUNT.unpack_from(buf, pos)
+                connection_counts[conid] = count
+            chunks.append(ChunkInfo(
+                pos=UINT64.unpack(header[b'chunk_pos'])[0],
+                start_time=to_nsec(*TIME.unpack(header[b'start_time'])),
+                end_time=to_nsec(*TIME.unpack(header[b'end_time'])),
+                connection_counts=connection_counts))
+    return Bagindex(version=200, connections=connections, chunks=chunks)
+
+
+def read_chunk_index(f, info):
+    """Read header of chunk and the index data records following it.
+
+    The size of the index data records is known from the chunk info,
+    they are read with one read after the chunk header, skipping the
+    chunk data.
+
+    Args:
+        f: Bag file object.
+        info: :class:`ChunkInfo` of chunk to read.
+
+    Returns:
+        :class:`Chunk` with entries mapping connection ids to lists
+        of (time, offset) tuples.
+    """
+    f.seek(info.pos)
+    size, = UINT32.unpack(f.read(4))
+    header = parse_header(f.read(size))
+    if _op(header) != OP_CHUNK:
+        raise CorruptBag('Expected chunk record at {}'.format(info.pos))
+    data_len, = UINT32.unpack(f.read(4))
+    data_pos = f.tell()
+    f.seek(data_len, 1)
+    buf = f.read(sum(INDEX_RECORD_OVERHEAD + count * INDEX_ENTRY.size
+                     for count in info.connection_counts.values()))
+
+    entries = {}
+    records = iter_records(buf)
+    for _ in range(len(info.connection_counts)):
+        try:
+            idxhdr, start, end = next(records)
+        except StopIteration:
+            raise CorruptBag('Missing index data records after chunk')
+        if _op(idxhdr) != OP_INDEX_DATA:
+            raise CorruptBag('Expected index data record after chunk')
+        ver, = UINT32.unpack(idxhdr[b'ver'])
+        if ver != 1:
+            raise Unsupported('Index data version {}'.format(ver))
+        conid, = UINT32.unpack(idxhdr[b'conn'])
+        entries[conid] = [(to_nsec(secs, nsecs), offset) for secs, nsecs, offset
+                          in (INDEX_ENTRY.unpack_from(buf, pos)
+                              for pos in range(start, end, INDEX_ENTRY.size))]
+    return Chunk(info=info,
+                 compression=header[b'compression'],
+                 size=UINT32.unpack(header[b'size'])[0],
+                 data_pos=data_pos,
+                 data_len=data_len,
+                 entries=entries)
+
+
+def _connection_record_size(con):
+    header = (4 + 4) + (4 + 9) + (4 + 6 + len(con.topic))
+    data = sum(4 + len(k) + 1 + len(v) for k, v in con.header.items())
+    return 4 + header + 4 + data
+
+
+def connection_stats(connections, chunks):
+    """Compute first and last timestamp and total size per connection.
+
+    Message sizes are derived from the offsets of consecutive index
+    entries, no message data is read.  They are exact for bags
+    written by ``rosbag``, whose record layout is assumed for the
+    message records and for connection records written into the
+    chunk before the first message of a connection; for other
+    writers they are approximate.
+
+    Args:
+        connections: Dictionary mapping connection ids to
+            :class:`Connection` instances.
+        chunks: List of :class:`Chunk` instances.
+
+    Returns:
+        Dictionary mapping connection ids to :class:`ConnectionStats`.
+    """
+    start_times = {}
+    end_times = {}
+    sizes = {}
+    for chunk in chunks:
+        offsets = sorted((offset, conid)
+                         for conid, entries in chunk.entries.items()
+                         for _, offset in entries)
+        ends = [x[0] for x in offsets[1:]] + [chunk.size]
+        prev = None
+        for (offset, conid), end in zip(offsets, ends):
+            if conid not in sizes:
+                sizes[conid] = 0
+                if prev is not None:
+                    sizes[prev] -= _connection_record_size(connections[conid])
+            sizes[conid] += end - offset - MSG_RECORD_OVERHEAD
+            prev = conid
+
+        for conid, entries in chunk.entries.items():
+            start = min(x[0] for x in entries)
+            end = max(x[0] for x in entries)
+            start_times[conid] = min(start, start_times.get(conid, start))
+            end_times[conid] = max(end, end_times.get(conid, end))
+    return {conid: ConnectionStats(start_times[conid], end_times[conid],
+                                   sizes[conid])
+            for conid in sizes}
+
+
+class _Done(object):
+    """Stand-in for AsyncResult of data that needs no decompression."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def _decompress(compression, data):
+    if compression == b'none':
+        return data
+    if compression == b'bz2':
+        return bz2.decompress(data)
+    if compression == b'lz4' and roslz4 is not None:
+        return roslz4.decompress(data)
+    raise Unsupported('Chunk compression {}'.format(compression))
+
+
+def _read_chunk_record(f, info):
+    f.seek(info.pos)
+    size, = UINT32.unpack(f.read(4))
+    header = parse_header(f.read(size))
+    if _op(header) != OP_CHUNK:
+        raise CorruptBag('Expected chunk record at {}'.format(info.pos))
+    data_len, = UINT32.unpack(f.read(4))
+    compression = header[b'compression']
+    if compression == b'none' and isinstance(f, mmap.mmap):
+        data = _buffer(f, f.tell(), data_len)
+    else:
+        data = f.read(data_len)
+    return compression, UINT32.unpack(header[b'size'])[0], data
+
+
+def read_chunk(f, info):
+    """Read and decompress data of chunk.
+
+    Returns:
+        Uncompressed chunk data.
+    """
+    compression, _, data = _read_chunk_record(f, info)
+    return _decompress(compression, data)
+
+
+def iter_chunks(f, chunks, pool=None, readahead=READAHEAD):
+    """Iterate uncompressed data of chunks in given order.
+
+    With a pool, compressed chunks are read ahead and decompressed by
+    the pool's workers while the current chunk is being consumed.
+    Workers decompress in parallel only as far as the decompressor
+    releases the GIL, as :mod:`bz2` does; otherwise decompression
+    merely overlaps with consuming messages.  Chunks are read ahead
+    as long as their total uncompressed size stays within readahead
+    bytes, or at least the next one.
+
+    Args:
+        f: Bag file object.
+        chunks: List of :class:`ChunkInfo` instances.
+        pool: A :class:`multiprocessing.pool.ThreadPool` or None,
+            only its apply_async is used and only for compressed
+            chunks.
+        readahead (int): Memory budget in bytes for chunks read ahead.
+    """
+    if pool is None:
+        for info in chunks:
+            yield read_chunk(f, info)
+        return
+
+    pending = deque()
+    inflight = 0
+    chunks = iter(chunks)
+    while True:
+        for info in chunks:
+            compression, size, data = _read_chunk_record(f, info)
+            if compression == b'none':
+                result = _Done(data)
+            else:
+                result = pool.apply_async(_decompress, (compression, data))
+            pending.append((size, result))
+            inflight += size
+            if inflight >= readahead:
+                break
+        if not pending:
+            break
+        size, result = pending.popleft()
+        inflight -= size
+        yield result.get()
+
+
+def read_messages(f, index, conids=None, start_time=0, end_time=sys.maxsize,
+                  positions=None, pool=None, readahead=READAHEAD):
+    """Iterate chronologically :class:`RawMessage` of bag file object f.
+
+    In contrast to reading along the index, chunks are read in file
+    order and each chunk is decompressed once.  Chunks without
+    messages of the requested connections or outside the time window
+    are skipped.  Messages are buffered and sorted as long as a later
+    chunk might contain older messages, i.e. only for chunks with
+    overlapping time ranges.  Messages with identical timestamps are
+    yielded in file order.  Message data are read-only buffers into
+    the chunk data, which are not copied for uncompressed chunks of
+    mapped bags.
+
+    Args:
+        f: Bag file object or mmap.
+        index: :class:`Bagindex` of bag.
+        conids: Set of connection ids to read, all if None.
+        start_time: Nanoseconds of earliest message to read.
+        end_time: Nanoseconds of latest message to read.
+        positions: Set of positions of chunks to read, all if None.
+        pool: Optional pool to decompress chunks read ahead with,
+            see :func:`iter_chunks`.
+        readahead (int): Memory budget in bytes for chunks read ahead.
+    """
+    chunks = [x for x in index.chunks
+              if (conids is None or
+                  not conids.isdisjoint(x.connection_counts)) and
+              (positions is None or x.pos in positions) and
+              x.start_time <= end_time and x.end_time >= start_time]
+
+    # Earliest start time of all chunks following the current one
+    horizons = []
+    horizon = sys.maxsize
+    for info in reversed(chunks):
+        horizons.append(horizon)
+        horizon = min(horizon, info.start_time)
+    horizons.reverse()
+
+    heap = []
+    seq = 0
+    datas = iter_chunks(f, chunks, pool=pool, readahead=readahead)
+    for info, horizon in zip(chunks, horizons):
+        data = next(datas)
+        offset = 0
+        for header, start, end in iter_records(data):
+            record_offset, offset = offset, end
+            if _op(header) != OP_MSG_DATA:
+                continue
+            conid, = UINT32.unpack(header[b'conn'])
+            if conids is not None and conid not in conids:
+                continue
+            time = to_nsec(*TIME.unpack(header[b'time']))
+            if not start_time <= time <= end_time:
+                continue
+            msg = RawMessage(conid, time, _buffer(data, start, end - start),
+                             (info.pos, record_offset))
+            heapq.heappush(heap, (time, seq, msg))
+            seq += 1
+        while heap and heap[0][0] < horizon:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
@@ -18,121 +18,913 @@
 
 from __future__ import absolute_import, division, print_function
 
+import functools
 import math
+import multiprocessing
+import os
+import shutil
+import struct
 import subprocess
-from itertools import count
+import tempfile
+from collections import deque
+from itertools import count, cycle
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from threading import Thread
+from Queue import Queue
 
 import cv_bridge
 import cv2
+import genpy
 import marv
+import marv_nodes
 import numpy
 
 from marv.types import File
-from .bag import get_message_type, messages
+from ._trampoline import trampoline
+from .bag import bagmeta, get_message_type, messages, read_messages
+from .bag import segment_times
 
-imgmsg_to_cv2 = cv_bridge.CvBridge().imgmsg_to_cv2
+_bridge = cv_bridge.CvBridge()
+cv2_to_imgmsg = _bridge.cv2_to_imgmsg
+imgmsg_to_cv2 = _bridge.imgmsg_to_cv2
+
+IMAGE_TYPES = ('sensor_msgs/Image', 'sensor_msgs/CompressedImage')
+COMPRESSED = 'sensor_msgs/CompressedImage'
+QUEUE_SIZE = 8
+THUMBNAIL_WORKERS = 4
+
+# Number of images extracted per topic by default
+IMAGE_COUNT = 50
+
+# Thumbnails for seeking in DASH videos, every SPRITE_INTERVAL seconds,
+# combined into sprites of SPRITE_TILE columns and rows.
+SPRITE_INTERVAL = 10
+SPRITE_TILE = (10, 10)
+SPRITE_WIDTH = 160
+
+# OpenCV flags decoding at 1/2, 1/4 and 1/8 of the size, for JPEG
+# already while decoding by scaling the DCT.
+REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+JPEG_SOF = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def image_streams(count=0):
+    """Select streams of all image topics, sampled to count messages.
+
+    Sampling is planned using the bag index, other messages are not
+    read.  For example, for 100 images per topic::
+
+        images_100 = images.clone(stream=image_streams(100),
+                                  max_frames=100)
+
+    Args:
+        count (int): Number of equidistantly spread messages, 0 for
+            all messages.
+    """
+    query = '?count={}'.format(count) if count else ''
+    return marv.select(messages, '*:{}{}'.format(','.join(IMAGE_TYPES), query))
+
+
+def encoder_threads(encodes, threads=0, thread_split=0, cores=None):
+    """Number of threads for each of concurrently running encodes.
+
+    All encodes run at the same time, the number of threads does not
+    limit how many.  Cores are divided by the number of encodes, or by
+    thread_split if smaller, oversubscribing the cores in that case.
+
+    Args:
+        encodes (int): Number of encodes running at the same time.
+        threads (int): Fixed number of threads, 0 to split cores.
+        thread_split (int): Divide cores by at most this number, 0
+            to divide them by the number of encodes.
+        cores (int): Number of cores, defaults to all.
+
+    Returns:
+        Number of threads, at least 1.
+    """
+    if threads:
+        return threads
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    if thread_split:
+        encodes = min(encodes, thread_split)
+    return max(1, cores // max(encodes, 1))
+
+
+def _write_frames(pipe, queue, errors):
+    """Write frames from queue to pipe until None is received.
+
+    After a failed write, frames are still taken from the queue, but
+    discarded, so the producer never blocks on a full queue.
+    """
+    while True:
+        frame = queue.get()
+        if frame is None:
+            break
+        if errors:
+            continue
+        try:
+            pipe.write(frame)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+
+
+def image_size(data):
+    """Return (width, height) from header of JPEG or PNG data.
+
+    Returns:
+        Tuple of width and height, or None for other or broken data.
+    """
+    if data[:8] == PNG_SIGNATURE:
+        if len(data) < 24 or data[12:16] != b'IHDR':
+            return None
+        return struct.unpack_from('>II', data, 16)
+    if data[:2] != b'\xff\xd8':
+        return None
+    pos = 2
+    while pos + 9 <= len(data):
+        prefix, marker = struct.unpack_from('BB', data, pos)
+        if prefix != 0xff:
+            return None
+        if marker == 0xff:
+            pos += 1
+            continue
+        if marker in JPEG_SOF:
+            height, width = struct.unpack_from('>HH', data, pos + 5)
+            return width, height
+        length, = struct.unpack_from('>H', data, pos + 2)
+        pos += 2 + length
+    return None
+
+
+def _unsupported(rosmsg):
+    """Whether frames of rosmsg cannot be decoded as images.
+
+    Depth images compressed by compressed_depth_image_transport are
+    prefixed with a header of quantization parameters and not
+    supported.
+    """
+    return rosmsg._type == COMPRESSED and 'compressedDepth' in rosmsg.format
+
+
+def _decode_thumbnail(data, width):
+    """Decode compressed image at reduced size of at least width."""
+    size = image_size(data)
+    flags = cv2.IMREAD_COLOR
+    if size is not None:
+        flags = next((flag for factor, flag in REDUCED_FLAGS
+                      if size[0] // factor >= width), flags)
+    return cv2.imdecode(numpy.frombuffer(data, numpy.uint8), flags)
+
+
+def video_size(width, height, max_width=0, max_height=0):
+    """Return decimation factor and size of video frames.
+
+    Frames are decimated by the smallest integer factor fitting them
+    into max_width and max_height, the resulting size is cropped to
+    even dimensions.
+
+    Args:
+        width, height (int): Size of images.
+        max_width, max_height (int): Maximum size, 0 for no limit.
+
+    Returns:
+        Tuple of factor, width, and height.
+    """
+    factor = max(int(math.ceil(width / max_width)) if max_width else 1,
+                 int(math.ceil(height / max_height)) if max_height else 1)
+    if factor <= 1:
+        return 1, width, height
+    return factor, width // factor // 2 * 2, height // factor // 2 * 2
+
+
+def _decimated(rosmsg):
+    """Whether frames of rosmsg are decimated before conversion.
+
+    Bayer patterns need to be debayered first, compressed images are
+    scaled by ffmpeg after decoding.
+    """
+    return (rosmsg._type != COMPRESSED and
+            not rosmsg.encoding.startswith('bayer'))
+
+
+def _frame_converter(convert_32FC1_scale, convert_32FC1_offset, buffers=1,
+                     max_width=0, max_height=0):
+    """Create function converting image messages to ffmpeg frames.
+
+    Frames are strings or arrays, passed on without copying.
+    Compressed images are passed on as they are, to be decoded by
+    ffmpeg.  For 32FC1 images, frames are written into a ring of
+    buffers, each reused only after the following buffers-1 frames
+    were converted.
+
+    Images exceeding max_width or max_height are decimated, see
+    :func:`video_size`, before being converted, unless they are
+    bayer encoded.
+    """
+    state = {}
+
+    def passthrough(rosmsg):
+        img = imgmsg_to_cv2(rosmsg, 'passthrough')
+        factor, width, height = state['size']
+        if factor > 1:
+            img = img[:height * factor:factor, :width * factor:factor]
+        return img
+
+    def convert(rosmsg):
+        if rosmsg._type == COMPRESSED:
+            return rosmsg.data
+        if not state:
+            if _decimated(rosmsg):
+                state['size'] = video_size(rosmsg.width, rosmsg.height,
+                                           max_width, max_height)
+            else:
+                state['size'] = (1, rosmsg.width, rosmsg.height)
+            if rosmsg.encoding == '32FC1':
+                _, width, height = state['size']
+                shape = (height, width)
+                state['floats'] = numpy.empty(shape, numpy.float32)
+                state['ring'] = cycle([numpy.empty(shape, numpy.uint8)
+                                       for _ in range(buffers)])
+        factor = state['size'][0]
+        if rosmsg.encoding == 'mono8' and factor == 1:
+            return rosmsg.data
+        if rosmsg.encoding in ('mono8', '8UC1'):
+            return numpy.ascontiguousarray(passthrough(rosmsg))
+        if rosmsg.encoding == '32FC1':
+            floats = state['floats']
+            numpy.copyto(floats, passthrough(rosmsg))
+            numpy.nan_to_num(floats, copy=False)
+            return cv2.convertScaleAbs(floats, next(state['ring']),
+                                       convert_32FC1_scale,
+                                       convert_32FC1_offset)
+        if factor > 1:
+            # Only the decimated pixels are converted
+            rosmsg = cv2_to_imgmsg(numpy.ascontiguousarray(passthrough(rosmsg)),
+                                   rosmsg.encoding)
+        return imgmsg_to_cv2(rosmsg, 'rgb8')
+    return convert
+
+
+def _output_args(path, segment_duration):
+    """Return ffmpeg output arguments for path.
+
+    For ``.mpd`` paths, a DASH manifest is written with WebM segments
+    of segment_duration seconds next to it, and a second output saves
+    sprites of thumbnails for :func:`_write_sprite_track`.
+    """
+    if not path.endswith('.mpd'):
+        return ['-y', path]
+    prefix = os.path.splitext(os.path.basename(path))[0]
+    cols, rows = SPRITE_TILE
+    return [
+        '-f', 'dash',
+        '-dash_segment_type', 'webm',
+        '-seg_duration', str(segment_duration),
+        '-use_template', '1',
+        '-use_timeline', '1',
+        '-init_seg_name', prefix + '-init.webm',
+        '-media_seg_name', prefix + '-$Number%05d$.webm',
+        '-y', path,
+        '-vf', 'fps=1/%d,scale=%d:-2,tile=%dx%d' % (
+            SPRITE_INTERVAL, SPRITE_WIDTH, cols, rows),
+        '-q:v', '5',
+        '-y', _sprite_pattern(path),
+    ]
+
+
+def _sprite_pattern(path):
+    return '{}-sprite-%03d.jpg'.format(os.path.splitext(path)[0])
+
+
+def _vtt_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return '%02d:%02d:%06.3f' % (hours, minutes, seconds)
+
+
+def _write_sprite_track(path, manifest, duration):
+    """Write WebVTT track referring to sprites of manifest to path.
+
+    Each cue of SPRITE_INTERVAL seconds refers to its thumbnail within
+    the sprites as media fragment, as used by video players for
+    previews while seeking.  The last cue ends at duration, videos
+    without duration get no cues.
+    """
+    pattern = _sprite_pattern(manifest)
+    sprites = []
+    while os.path.exists(pattern % (len(sprites) + 1)):
+        sprites.append(pattern % (len(sprites) + 1))
+    cols, rows = SPRITE_TILE
+    with open(path, 'w') as f:
+        f.write('WEBVTT\n')
+        if not sprites:
+            return
+        height, width = cv2.imread(sprites[0]).shape[:2]
+        width //= cols
+        height //= rows
+        count = min(int(math.ceil(duration / SPRITE_INTERVAL)),
+                    len(sprites) * cols * rows)
+        for idx in range(count):
+            sprite, pos = divmod(idx, cols * rows)
+            start = idx * SPRITE_INTERVAL
+            end = min(start + SPRITE_INTERVAL, duration)
+            f.write('\n{} --> {}\n{}#xywh={},{},{},{}\n'.format(
+                _vtt_time(start), _vtt_time(end),
+                os.path.basename(sprites[sprite]),
+                pos % cols * width, pos // cols * height, width, height))
+
+
+def _gop(framerate, segment_duration):
+    """Number of frames between keyframes of DASH segments."""
+    return max(1, int(round(framerate * segment_duration)))
+
+
+def _ffmpeg_args(rosmsg, path, framerate, threads, speed, max_width=0,
+                 max_height=0, segment_duration=0):
+    if rosmsg._type == COMPRESSED:
+        # Encoded frames are decoded by ffmpeg's image demuxer
+        inputargs = [
+            '-f', 'image2pipe',
+            '-c:v', 'png' if 'png' in rosmsg.format else 'mjpeg',
+        ]
+        size = image_size(rosmsg.data)
+        if size is None:
+            getLogger(__name__).warn('Cannot read size from %s header of %s, '
+                                     'video is not downsampled',
+                                     rosmsg.format, path)
+            size = (0, 0)
+    else:
+        size = (rosmsg.width, rosmsg.height)
+        if _decimated(rosmsg):
+            _, width, height = video_size(rosmsg.width, rosmsg.height,
+                                          max_width, max_height)
+        else:
+            width, height = size
+        inputargs = [
+            '-f', 'rawvideo',
+            '-pixel_format', '%s' % {
+                'mono8': 'gray',
+                '32FC1': 'gray',
+                '8UC1': 'gray',
+            }.get(rosmsg.encoding, 'rgb24'),
+            '-video_size', '%dx%d' % (width, height),
+        ]
+
+    # Frames not decimated by the converter are scaled by ffmpeg
+    factor, width, height = video_size(size[0], size[1], max_width, max_height)
+    if factor > 1 and not _decimated(rosmsg):
+        filterargs = ['-vf', 'scale=%d:%d' % (width, height)]
+    else:
+        filterargs = []
+
+    # Keyframes at the start of each DASH segment
+    if segment_duration:
+        gop = str(_gop(framerate, segment_duration))
+        filterargs += ['-g', gop, '-keyint_min', gop]
+
+    return ['ffmpeg'] + inputargs + [
+        '-framerate', '%s' % framerate,
+        '-i', '-',
+    ] + filterargs + [
+        '-c:v', 'libvpx-vp9',
+        '-pix_fmt', 'yuv420p',
+        '-loglevel', 'error',
+        '-threads', str(threads),
+        '-speed', str(speed),
+    ] + _output_args(path, segment_duration)
+
+
+def _encode_segment(paths, topic, window, pytype, convert, ffargs, path):
+    """Read and encode messages of topic within window into path."""
+    rosmsg = pytype()
+    encoder = None
+    try:
+        start_time, end_time = (genpy.Time(*divmod(x, 1000000000))
+                                for x in window)
+        for _, raw, _ in read_messages(paths, [topic], start_time, end_time,
+                                       chunkscan=True):
+            rosmsg.deserialize(bytes(raw[1]))
+            if _unsupported(rosmsg):
+                break
+            if encoder is None:
+                encoder = subprocess.Popen(ffargs(rosmsg, path),
+                                           stdin=subprocess.PIPE)
+            encoder.stdin.write(convert(rosmsg))
+    finally:
+        if encoder is not None:
+            encoder.stdin.close()
+            encoder.wait()
+
+
+def _encode_segments(paths, topic, windows, pytype, converter, ffargs, path,
+                     segment_duration=0):
+    """Encode windows of topic in parallel and concatenate them into path.
+
+    Segments start with a keyframe and are encoded with the same
+    settings, therefore they are concatenated without re-encoding.
+    Nothing is written for topics of unsupported frames.
+    Each segment is read and converted in its own thread, only the
+    encodes by ffmpeg run truly in parallel.
+    """
+    tmpdir = tempfile.mkdtemp()
+    pool = ThreadPool(len(windows))
+    try:
+        segments = [os.path.join(tmpdir, '{:04d}.webm'.format(idx))
+                    for idx in range(len(windows))]
+        results = [pool.apply_async(_encode_segment,
+                                    (paths, topic, window, pytype, converter(),
+                                     ffargs, segment))
+                   for window, segment in zip(windows, segments)]
+        for result in results:
+            result.get()
+        segments = [x for x in segments if os.path.exists(x)]
+        if not segments:
+            return
+        listfile = os.path.join(tmpdir, 'segments.txt')
+        with open(listfile, 'w') as f:
+            f.writelines("file '{}'\n".format(x) for x in segments)
+        subprocess.check_call(['ffmpeg', '-f', 'concat', '-safe', '0',
+                               '-i', listfile,
+                               '-c', 'copy', '-loglevel', 'error'] +
+                              _output_args(path, segment_duration))
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmpdir)
+
+
+def _topic_span(bagmeta, topic):
+    """Start time, end time and message count of topic from bagmeta."""
+    cons = [x for x in bagmeta.connections if x.topic == topic and x.msg_count]
+    if not cons:
+        return 0, 0, 0
+    return (min(x.start_time for x in cons), max(x.end_time for x in cons),
+            sum(x.msg_count for x in cons))
+
+
+def _video_params(bagmeta, start_time, end_time, msg_count):
+    """Return number of concurrent encodes, duration and framerate.
+
+    All image topics are encoded at the same time, the duration in
+    seconds and framerate are those of a topic with msg_count messages
+    between start_time and end_time.
+    """
+    encodes = len({x.topic for x in bagmeta.connections
+                   if x.datatype in IMAGE_TYPES})
+    duration = (end_time - start_time) * 1e-9
+    framerate = msg_count / duration if duration else 1
+    return encodes, duration, framerate
+
+
+def _encoder(framerate, threads, speed, max_width, max_height,
+             convert_32FC1_scale, convert_32FC1_offset, segment_duration=0):
+    """Return ffmpeg arguments and frame converter factory of an encode.
+
+    The arguments are created with the first message and output path,
+    see :func:`_ffmpeg_args`, converters with the number of buffers,
+    see :func:`_frame_converter`.
+    """
+    ffargs = functools.partial(_ffmpeg_args, framerate=framerate,
+                               threads=threads, speed=speed,
+                               max_width=max_width, max_height=max_height,
+                               segment_duration=segment_duration)
+    converter = functools.partial(_frame_converter, convert_32FC1_scale,
+                                  convert_32FC1_offset, max_width=max_width,
+                                  max_height=max_height)
+    return ffargs, converter
+
+
+def _save_thumbnail(img, image_width, path):
+    """Scale img to image_width, keeping aspect ratio, and save as JPEG."""
+    height = int(round(image_width * img.shape[0] / img.shape[1]))
+    scaled_img = cv2.resize(img, (image_width, height),
+                            interpolation=cv2.INTER_AREA)
+    cv2.imwrite(path, scaled_img, (cv2.IMWRITE_JPEG_QUALITY, 60))
+
+
+def _thumbnail_template(stream):
+    """Template for thumbnail names, formatted with index in topic."""
+    every = getattr(stream, 'every', None) or 1
+    msg_count = max(stream.msg_count * every, 2)
+    digits = int(math.ceil(math.log(msg_count) / math.log(10)))
+    return '%s-{:0%sd}.jpg' % (stream.topic.replace('/', ':')[1:], digits)
+
+
+def _encode(stream, path, ffargs, convert, thumbnails=None):
+    """Body encoding stream into video at path within a single pass.
+
+    Frames are converted here while a writer thread feeds them to an
+    ffmpeg started with arguments from ffargs.  Buffers of convert need
+    to be reused only after the writer is done with them: up to
+    QUEUE_SIZE frames are queued, one is being written and one is
+    being converted.
+
+    With thumbnails being a tuple of image_width and step, the first
+    and then every step-th frame is also scaled, saved and pushed.
+    """
+    pytype = get_message_type(stream)
+    rosmsg = pytype()
+    template = _thumbnail_template(stream)
+    queue = Queue(QUEUE_SIZE)
+    errors = []
+    encoder = None
+    writer = None
+    try:
+        for idx in count():
+            if errors:
+                break
+            msg = yield marv.pull(stream)
+            if msg is None:
+                break
+            rosmsg.deserialize(msg.data)
+            if _unsupported(rosmsg):
+                log = yield marv.get_logger()
+                log.warn('skipping %s, %s is not supported', stream.topic,
+                         rosmsg.format)
+                break
+            if not encoder:
+                encoder = subprocess.Popen(ffargs(rosmsg, path),
+                                           stdin=subprocess.PIPE)
+                writer = Thread(target=_write_frames,
+                                args=(encoder.stdin, queue, errors))
+                writer.daemon = True
+                writer.start()
+            frame = convert(rosmsg)
+            if isinstance(frame, numpy.ndarray):
+                # The writer needs contiguous memory, copy if not
+                frame = numpy.ascontiguousarray(frame)
+            queue.put(frame)
+
+            if thumbnails is None or idx % thumbnails[1]:
+                continue
+            image_width = thumbnails[0]
+            if rosmsg._type == COMPRESSED:
+                img = _decode_thumbnail(frame, image_width)
+                if img is None:
+                    log = yield marv.get_logger()
+                    log.warn('skipping thumbnail of broken image %d of %s',
+                             idx, stream.topic)
+                    continue
+            elif isinstance(frame, numpy.ndarray):
+                img = frame
+            else:
+                img = imgmsg_to_cv2(rosmsg)
+            imgfile = yield marv.make_file(template.format(idx))
+            _save_thumbnail(img, image_width, imgfile.path)
+            yield imgfile
+    finally:
+        if writer:
+            queue.put(None)
+            writer.join()
+            encoder.stdin.close()
+            encoder.wait()
+
+    if errors:
+        raise errors[0]
+
+
+def _ffmpeg(stream, bagmeta, dataset, speed, threads, thread_split, segments,
+            max_width, max_height, dash, dash_segment_duration,
+            convert_32FC1_scale, convert_32FC1_offset):
+    """Body of :func:`ffmpeg` and, with dataset, :func:`ffmpeg_segmented`."""
+    yield marv.set_header(title=stream.topic)
+    bagmeta = yield marv.pull(bagmeta)
+    name = stream.topic.replace('/', '_')[1:]
+    segment_duration = dash_segment_duration if dash else 0
+    video = yield marv.make_file('{}.{}'.format(name,
+                                                'mpd' if dash else 'webm'))
+    if dataset is not None:
+        start_time, end_time, msg_count = _topic_span(bagmeta, stream.topic)
+    else:
+        start_time, end_time, msg_count = \
+            stream.start_time, stream.end_time, stream.msg_count
+    encodes, duration, framerate = _video_params(bagmeta, start_time, end_time,
+                                                 msg_count)
+
+    # DASH output is written next to its manifest into a temporary
+    # directory, to be moved into files made by marv afterwards.
+    tmpdir = tempfile.mkdtemp() if dash else None
+    path = video.path
+    if dash:
+        path = os.path.join(tmpdir, os.path.basename(video.path))
+    encoder = functools.partial(_encoder, framerate, speed=speed,
+                                max_width=max_width, max_height=max_height,
+                                convert_32FC1_scale=convert_32FC1_scale,
+                                convert_32FC1_offset=convert_32FC1_offset,
+                                segment_duration=segment_duration)
+    try:
+        if dataset is not None:
+            dataset = yield marv.pull(dataset)
+            paths = [x.path for x in dataset.files if x.path.endswith('.bag')]
+            align = _gop(framerate, segment_duration) if dash else 1
+            windows = segment_times(paths, stream.topic, segments, start_time,
+                                    end_time, align)
+            ffargs, converter = encoder(encoder_threads(
+                encodes * len(windows), threads, thread_split))
+            if windows:
+                _encode_segments(paths, stream.topic, windows,
+                                 get_message_type(stream), converter, ffargs,
+                                 path, segment_duration)
+        else:
+            ffargs, converter = encoder(encoder_threads(encodes, threads,
+                                                        thread_split))
+            yield _encode(stream, path, ffargs,
+                          converter(buffers=QUEUE_SIZE + 2))
+
+        # No video for streams without messages
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        if not dash:
+            yield video
+            return
+
+        _write_sprite_track(os.path.join(tmpdir, '{}.vtt'.format(name)), path,
+                            duration)
+        shutil.move(path, video.path)
+        yield video
+        for filename in sorted(os.listdir(tmpdir),
+                               key=lambda x: (x.endswith('.vtt'), x)):
+            outfile = yield marv.make_file(filename)
+            shutil.move(os.path.join(tmpdir, filename), outfile.path)
+            yield outfile
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
 
 
 @marv.node(File)
-@marv.input('stream', foreach=marv.select(messages, '*:sensor_msgs/Image'))
+@marv.input('stream', foreach=image_streams())
+@marv.input('bagmeta', default=bagmeta)
 @marv.input('speed', default=4)
+@marv.input('threads', default=0)
+@marv.input('thread_split', default=0)
+@marv.input('max_width', default=0)
+@marv.input('max_height', default=0)
+@marv.input('dash', default=False)
+@marv.input('dash_segment_duration', default=4)
 @marv.input('convert_32FC1_scale', default=1)
 @marv.input('convert_32FC1_offset', default=0)
-def ffmpeg(stream, speed, convert_32FC1_scale, convert_32FC1_offset):
-    """Create video for each sensor_msgs/Image topic with ffmpeg"""
-    yield marv.set_header(title=stream.topic)
-    name = '{}.webm'.format(stream.topic.replace('/', '_')[1:])
-    video = yield marv.make_file(name)
-    duration = (stream.end_time - stream.start_time) * 1e-9
-    framerate = stream.msg_count / duration
+@trampoline
+def ffmpeg(stream, bagmeta, speed, threads, thread_split, max_width, max_height,
+           dash, dash_segment_duration, convert_32FC1_scale,
+           convert_32FC1_offset):
+    """Create video for each image topic with ffmpeg
 
-    pytype = get_message_type(stream)
-    rosmsg = pytype()
+    Topics of sensor_msgs/Image are converted to raw frames, JPEG or
+    PNG encoded frames of sensor_msgs/CompressedImage topics are
+    piped into ffmpeg without decoding.  Topics of compressedDepth
+    encoded depth images are skipped with a warning.
 
-    encoder = None
-    while True:
-        msg = yield marv.pull(stream)
-        if msg is None:
-            break
-        rosmsg.deserialize(msg.data)
-        if not encoder:
-            ffargs = [
-                'ffmpeg',
-                '-f', 'rawvideo',
-                '-pixel_format', '%s' % {'mono8': 'gray',
-                                         '32FC1': 'gray',
-                                         '8UC1': 'gray'}.get(rosmsg.encoding, 'rgb24'),
-                '-video_size', '%dx%d' % (rosmsg.width, rosmsg.height),
-                '-framerate', '%s' % framerate,
-                '-i', '-',
-                '-c:v', 'libvpx-vp9',
-                '-pix_fmt', 'yuv420p',
-                '-loglevel', 'error',
-                '-threads', '8',
-                '-speed', str(speed),
-                '-y',
-                video.path,
-            ]
-            encoder = subprocess.Popen(ffargs, stdin=subprocess.PIPE)
-
-        if rosmsg.encoding == 'mono8':
-            data = rosmsg.data
-        elif rosmsg.encoding == '32FC1':
-            data = cv2.convertScaleAbs(numpy.nan_to_num(imgmsg_to_cv2(rosmsg, 'passthrough')),
-                                       None, convert_32FC1_scale, convert_32FC1_offset)
-        elif rosmsg.encoding == '8UC1':
-            data = imgmsg_to_cv2(rosmsg).tobytes()
-        else:
-            data = imgmsg_to_cv2(rosmsg, 'rgb8').tobytes()
-        encoder.stdin.write(data)
+    The streams of all image topics are read in one pass over the
+    bags, therefore their encodes run at the same time.  Unless
+    threads is set, the cores are split evenly across them, see
+    :func:`encoder_threads`.  For encoding long topics in parallel
+    segments see :func:`ffmpeg_segmented`.
 
-    encoder.stdin.close()
-    encoder.wait()
-    yield video
+    Videos of images larger than max_width or max_height are
+    downsampled by an integer factor, see :func:`video_size`.  Raw
+    images are decimated before conversion, bayer encoded and
+    compressed images are scaled by ffmpeg.
+
+    With dash, a DASH manifest with WebM segments of
+    dash_segment_duration seconds is created instead of a single
+    WebM file, for players to fetch only what is viewed.  Once
+    encoded, the manifest is pushed, followed by the initialization
+    and media segments, the thumbnail sprites and a WebVTT track
+    referring to them for previews while seeking.  Nothing is pushed
+    while encoding, videos cannot be watched before they are
+    complete.  See :func:`marv_robotics.detail.video_section` for
+    displaying them.
+
+    Args:
+        threads (int): Threads per encode, 0 to split cores.
+        thread_split (int): Divide cores by at most this number,
+            0 for the number of image topics; does not limit how
+            many encodes run at the same time.
+        max_width (int): Maximum width of video, 0 for no limit.
+        max_height (int): Maximum height of video, 0 for no limit.
+        dash (bool): Create DASH manifest and segments.
+        dash_segment_duration (int): Duration of segments in seconds.
+    """
+    yield _ffmpeg(stream, bagmeta, None, speed, threads, thread_split, 1,
+                  max_width, max_height, dash, dash_segment_duration,
+                  convert_32FC1_scale, convert_32FC1_offset)
 
 
 @marv.node(File)
-@marv.input('stream', foreach=marv.select(messages, '*:sensor_msgs/Image'))
+@marv.input('stream', foreach=image_streams(1))
+@marv.input('dataset', default=marv_nodes.dataset)
+@marv.input('bagmeta', default=bagmeta)
+@marv.input('speed', default=4)
+@marv.input('threads', default=0)
+@marv.input('thread_split', default=0)
+@marv.input('segments', default=4)
+@marv.input('max_width', default=0)
+@marv.input('max_height', default=0)
+@marv.input('dash', default=False)
+@marv.input('dash_segment_duration', default=4)
+@marv.input('convert_32FC1_scale', default=1)
+@marv.input('convert_32FC1_offset', default=0)
+@trampoline
+def ffmpeg_segmented(stream, dataset, bagmeta, speed, threads, thread_split,
+                     segments, max_width, max_height, dash,
+                     dash_segment_duration, convert_32FC1_scale,
+                     convert_32FC1_offset):
+    """Create video for each image topic, encoding segments in parallel
+
+    Like :func:`ffmpeg`, but each topic is split into up to segments
+    time segments with about the same number of frames, using the bag
+    index.  Each segment is read from the bags and encoded in
+    parallel, the resulting videos are concatenated without
+    re-encoding.  With dash, the segments start at multiples of the
+    DASH segment duration to keep keyframes aligned.
+
+    Frames are not read via :func:`marv_robotics.bag.messages`, the
+    streams selected are sampled to one message only to tell the
+    image topics; start, end and message count of a topic are taken
+    from bagmeta.  The encodes run as separate ffmpeg processes,
+    reading and converting frames for them happens in threads of this
+    process and is bound by the GIL.
+
+    The other inputs are those of :func:`ffmpeg`.  The videos are
+    displayed by a clone of :func:`marv_robotics.detail.video_section`::
+
+        segmented_section = video_section.clone(videos=ffmpeg_segmented)
+
+    Args:
+        segments (int): Number of segments encoded in parallel.
+    """
+    yield _ffmpeg(stream, bagmeta, dataset, speed, threads, thread_split,
+                  segments, max_width, max_height, dash, dash_segment_duration,
+                  convert_32FC1_scale, convert_32FC1_offset)
+
+
+@marv.node(File)
+@marv.input('stream', foreach=image_streams())
 @marv.input('image_width', default=320)
-@marv.input('max_frames', default=50)
+@marv.input('max_frames', default=IMAGE_COUNT)
 @marv.input('convert_32FC1_scale', default=1)
 @marv.input('convert_32FC1_offset', default=0)
 def images(stream, image_width, max_frames, convert_32FC1_scale, convert_32FC1_offset):
     """
-    Extract max_frames equidistantly spread images from each sensor_msgs/Image stream.
+    Extract max_frames equidistantly spread images from each
+    sensor_msgs/Image or CompressedImage stream.
+
+    All messages of the stream are read, see :data:`sampled_images`
+    for reading only the extracted images.  Image files are numbered
+    by their index within the topic, also for sampled streams.
+
+    Compressed images are decoded at the smallest of 1/2, 1/4 or 1/8
+    of their size that is still at least image_width wide, for JPEG
+    already while decoding.  Topics of compressedDepth encoded depth
+    images are skipped with a warning.
 
     Args:
-        stream: sensor_msgs/Image stream
+        stream: sensor_msgs/Image or CompressedImage stream
         image_width (int): Scale to image_width, keeping aspect ratio.
         max_frames (int): Maximum number of frames to extract.
     """
     yield marv.set_header(title=stream.topic)
+    interval = max(1, int(math.ceil(stream.msg_count / max_frames)))
+    every = getattr(stream, 'every', None) or 1
     pytype = get_message_type(stream)
     rosmsg = pytype()
-    interval = int(math.ceil(stream.msg_count / max_frames))
-    digits = int(math.ceil(math.log(stream.msg_count) / math.log(10)))
-    name_template = '%s-{:0%sd}.jpg' % (stream.topic.replace('/', ':')[1:], digits)
+    name_template = _thumbnail_template(stream)
     counter = count()
+
+    # Scaling and encoding release the GIL and run in a pool, while
+    # the next images are read; files are yielded in order.
+    pool = ThreadPool(THUMBNAIL_WORKERS)
+    pending = deque()
+    try:
+        while True:
+            msg = yield marv.pull(stream)
+            if msg is None:
+                break
+            idx = counter.next()
+            if idx % interval:
+                continue
+
+            rosmsg.deserialize(msg.data)
+            if _unsupported(rosmsg):
+                log = yield marv.get_logger()
+                log.warn('skipping %s, %s is not supported', stream.topic,
+                         rosmsg.format)
+                break
+            if rosmsg._type == COMPRESSED:
+                img = _decode_thumbnail(rosmsg.data, image_width)
+                if img is None:
+                    log = yield marv.get_logger()
+                    log.warn('skipping broken image %d of %s',
+                             idx * every, stream.topic)
+                    continue
+            elif rosmsg.encoding == '32FC1':
+                img = numpy.nan_to_num(imgmsg_to_cv2(rosmsg, 'passthrough'))
+                img = cv2.convertScaleAbs(img, None, convert_32FC1_scale,
+                                          convert_32FC1_offset)
+            elif rosmsg.encoding == '8UC1':
+                img = imgmsg_to_cv2(rosmsg)
+            else:
+                img = imgmsg_to_cv2(rosmsg, "rgb8")
+            name = name_template.format(idx * every)
+            imgfile = yield marv.make_file(name)
+            result = pool.apply_async(_save_thumbnail,
+                                      (img, image_width, imgfile.path))
+            pending.append((result, imgfile))
+            if len(pending) > 2 * THUMBNAIL_WORKERS:
+                result, imgfile = pending.popleft()
+                result.get()
+                yield imgfile
+
+        pool.close()
+        for result, imgfile in pending:
+            result.get()
+            yield imgfile
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# Images like with images, but reading only the extracted images.  For
+# another number of images also select streams with image_streams.
+sampled_images = images.clone(stream=image_streams(IMAGE_COUNT))
+
+
+@marv.node(File)
+@marv.input('stream', foreach=image_streams())
+@marv.input('bagmeta', default=bagmeta)
+@marv.input('speed', default=4)
+@marv.input('threads', default=0)
+@marv.input('thread_split', default=0)
+@marv.input('image_width', default=320)
+@marv.input('image_count', default=IMAGE_COUNT)
+@marv.input('max_width', default=0)
+@marv.input('max_height', default=0)
+@marv.input('convert_32FC1_scale', default=1)
+@marv.input('convert_32FC1_offset', default=0)
+@trampoline
+def camera(stream, bagmeta, speed, threads, thread_split, image_width,
+           image_count, max_width, max_height, convert_32FC1_scale,
+           convert_32FC1_offset):
+    """Create video and images for each image topic in one pass.
+
+    Like :func:`ffmpeg` and :func:`images` together, but each frame is
+    deserialized and converted only once, for the encoder and, for
+    up to image_count equidistantly spread frames, for the images.
+    The output streams contain the images followed by the video.
+    Images are created from the frames of the video, i.e. after
+    downsampling to max_width and max_height.
+
+    The videos and images are displayed by
+    :data:`marv_robotics.detail.camera_video_section` and
+    :data:`marv_robotics.detail.camera_images_section`.
+    """
+    yield marv.set_header(title=stream.topic)
+    bagmeta = yield marv.pull(bagmeta)
+    name = '{}.webm'.format(stream.topic.replace('/', '_')[1:])
+    video = yield marv.make_file(name)
+    encodes, _, framerate = _video_params(bagmeta, stream.start_time,
+                                          stream.end_time, stream.msg_count)
+    step = max(1, int(math.ceil(stream.msg_count / image_count)))
+    threads = encoder_threads(encodes, threads, thread_split)
+    ffargs, converter = _encoder(framerate, threads, speed, max_width,
+                                 max_height, convert_32FC1_scale,
+                                 convert_32FC1_offset)
+    yield _encode(stream, video.path, ffargs, converter(buffers=QUEUE_SIZE + 2),
+                  thumbnails=(image_width, step))
+    if os.path.getsize(video.path):
+        yield video
+
+
+@marv.node(File)
+@marv.input('stream', foreach=camera)
+def camera_videos(stream):
+    """Video of each image topic created by :func:`camera`."""
+    yield marv.set_header(title=stream.title)
     while True:
         msg = yield marv.pull(stream)
         if msg is None:
             break
-        idx = counter.next()
-        if idx % interval:
-            continue
+        if msg.path.endswith('.webm'):
+            yield msg
 
-        rosmsg.deserialize(msg.data)
-        if rosmsg.encoding == '32FC1':
-            img = cv2.convertScaleAbs(numpy.nan_to_num(imgmsg_to_cv2(rosmsg, 'passthrough')),
-                                      None, convert_32FC1_scale, convert_32FC1_offset)
-        elif rosmsg.encoding == '8UC1':
-            img = imgmsg_to_cv2(rosmsg)
-        else:
-            img = imgmsg_to_cv2(rosmsg, "rgb8")
-        height = int(round(image_width * img.shape[0] / img.shape[1]))
-        scaled_img = cv2.resize(img, (image_width, height),
-                                interpolation=cv2.INTER_AREA)
-        name = name_template.format(idx)
-        imgfile = yield marv.make_file(name)
-        cv2.imwrite(imgfile.path, scaled_img, (cv2.IMWRITE_JPEG_QUALITY, 60))
-        yield imgfile
+
+@marv.node(File)
+@marv.input('stream', foreach=camera)
+def camera_images(stream):
+    """Images of each image topic created by :func:`camera`."""
+    yield marv.set_header(title=stream.title)
+    while True:
+        msg = yield marv.pull(stream)
+        if msg is None:
+            break
+        if msg.path.endswith('.jpg'):
+            yield msg
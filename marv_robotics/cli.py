@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+
+import click
+
+from marv.cli import create_app
+from marv_cli import marv as marvcli
+from .watch import watch
+
+
+@marvcli.command('watch')
+@click.option('--settle', default=2., show_default=True,
+              help='Seconds a directory needs to be idle before it is scanned')
+@click.option('--stale', default=600., show_default=True,
+              help='Seconds after which .bag.active files are considered stale')
+def marvcli_watch(settle, stale):
+    """Watch scanroots and scan directories as they change (Linux only)"""
+    watch(create_app().site, settle=settle, stale=stale)
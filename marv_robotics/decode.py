@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Decode batches of serialized ROS messages into NumPy arrays.
+
+For message types with a fixed layout, serialized messages are plain
+packed C structs and NumPy decodes a whole batch of them at once,
+instead of deserializing each message into a genpy instance.  The
+only variable length field supported is the ``frame_id`` of a leading
+``std_msgs/Header``, as found in most sensor messages; messages are
+grouped by its length.  Other message types are decoded one by one
+with genpy by :func:`genpy_decoder` into arrays of the same layout.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import re
+import struct
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+
+class Unsupported(Exception):
+    """Message type has no fixed layout."""
+
+
+PRIMITIVES = {
+    'bool': '?',
+    'int8': 'i1',
+    'byte': 'i1',
+    'uint8': 'u1',
+    'char': 'u1',
+    'int16': '<i2',
+    'uint16': '<u2',
+    'int32': '<i4',
+    'uint32': '<u4',
+    'int64': '<i8',
+    'uint64': '<u8',
+    'float32': '<f4',
+    'float64': '<f8',
+    'time': [('secs', '<u4'), ('nsecs', '<u4')],
+    'duration': [('secs', '<i4'), ('nsecs', '<i4')],
+}
+
+HEADER = 'std_msgs/Header'
+UINT32 = struct.Struct('<I')
+
+Field = namedtuple('Field', 'name type array')
+
+_FIELD_TYPE = re.compile(r'^([^\[]+)(?:\[(\d*)\])?$')
+
+
+def parse_definitions(datatype, msg_def):
+    """Parse concatenated message definitions as stored in bags.
+
+    Returns:
+        Dictionary mapping datatypes to lists of :class:`Field`, with
+        types of fields resolved to full names and array being None
+        for scalars, 0 for variable length arrays, and the length for
+        fixed length arrays.  Constants are omitted.
+    """
+    defs = {datatype: []}
+    current = datatype
+    for line in msg_def.splitlines():
+        if line.startswith('=') and not line.strip('='):
+            current = None
+            continue
+        if current is None:
+            if line.startswith('MSG: '):
+                current = line[5:].strip()
+                defs[current] = []
+            continue
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        fieldtype, name = line.split(None, 1)
+        if '=' in name:
+            continue
+        base, array = _FIELD_TYPE.match(fieldtype).groups()
+        if base == 'Header':
+            base = HEADER
+        elif base not in PRIMITIVES and base != 'string' and '/' not in base:
+            base = '{}/{}'.format(current.split('/')[0], base)
+        if array is not None:
+            array = int(array or 0)
+        defs[current].append(Field(name=name.strip(), type=base, array=array))
+    return defs
+
+
+def _dtype(datatype, defs):
+    if datatype in PRIMITIVES:
+        return PRIMITIVES[datatype]
+    if datatype == 'string' or datatype not in defs:
+        raise Unsupported('{} has no fixed layout'.format(datatype))
+    return [_field_dtype(datatype, x, defs) for x in defs[datatype]]
+
+
+def _field_dtype(datatype, field, defs):
+    if field.array == 0:
+        raise Unsupported('{}.{} has variable length'
+                          .format(datatype, field.name))
+    dtype = _dtype(field.type, defs)
+    if field.array is None:
+        return (str(field.name), dtype)
+    return (str(field.name), dtype, (field.array,))
+
+
+def _header_dtype(size):
+    fields = [('seq', '<u4'),
+              ('stamp', PRIMITIVES['time']),
+              ('frame_id_len', '<u4')]
+    if size:
+        fields.append(('frame_id', 'S{}'.format(size)))
+    return fields
+
+
+def _frombuffer(datas, dtype):
+    for data in datas:
+        if len(data) != dtype.itemsize:
+            raise ValueError('Message of {} bytes does not match layout of '
+                             '{} bytes'.format(len(data), dtype.itemsize))
+    return np.frombuffer(b''.join(datas), dtype)
+
+
+def decoder(datatype, msg_def):
+    """Create function decoding batches of messages of datatype.
+
+    Args:
+        datatype (str): Message type, e.g. ``sensor_msgs/NavSatFix``.
+        msg_def (str): Full message definition, as stored in bags.
+
+    Returns:
+        Function turning a list of serialized messages into a NumPy
+        structured array with one field per message field, named
+        like the message fields.  Times are structured with secs and
+        nsecs, the frame_id of a leading header is a byte string.
+
+    Raises:
+        Unsupported: Message type has no fixed layout.
+    """
+    defs = parse_definitions(datatype, msg_def)
+    fields = defs[datatype]
+    header = (bool(fields) and fields[0].type == HEADER and
+              fields[0].array is None)
+    if header:
+        fields = fields[1:]
+    rest = [_field_dtype(datatype, x, defs) for x in fields]
+
+    if not header:
+        dtype = np.dtype(rest)
+        return lambda datas: _frombuffer(datas, dtype)
+
+    name = str(defs[datatype][0].name)
+
+    def decode(datas):
+        groups = defaultdict(list)
+        for idx, data in enumerate(datas):
+            groups[UINT32.unpack_from(data, 12)[0]].append(idx)
+        size = max(groups) if groups else 0
+        out = np.empty(len(datas), np.dtype(
+            [(name, [('seq', '<u4'), ('stamp', PRIMITIVES['time']),
+                     ('frame_id', 'S{}'.format(max(size, 1)))])] + rest))
+        for size, idxs in groups.items():
+            arr = _frombuffer([datas[x] for x in idxs],
+                              np.dtype([(name, _header_dtype(size))] + rest))
+            idxs = np.array(idxs)
+            out[name]['seq'][idxs] = arr[name]['seq']
+            out[name]['stamp'][idxs] = arr[name]['stamp']
+            out[name]['frame_id'][idxs] = arr[name]['frame_id'] if size else b''
+            for field in rest:
+                out[field[0]][idxs] = arr[field[0]]
+        return out
+    return decode
+
+
+def _genpy_values(value, dtype):
+    if dtype.names:
+        return tuple(_genpy_values(getattr(value, name), dtype.fields[name][0])
+                     for name in dtype.names)
+    if dtype.subdtype:
+        return [_genpy_values(x, dtype.subdtype[0]) for x in value]
+    return value
+
+
+def genpy_decoder(pytype, dtype):
+    """Create function decoding batches of messages with genpy.
+
+    Fallback for message types not supported by :func:`decoder`.
+    Messages are deserialized one by one into pytype instances and
+    the fields of dtype are taken from attributes of the same names;
+    top-level fields pytype lacks are omitted.
+
+    Args:
+        pytype: Message class generated by genpy.
+        dtype: NumPy structured dtype with the fields to decode,
+            laid out like returned by :func:`decoder`.
+
+    Returns:
+        Function turning a list of serialized messages into a NumPy
+        structured array.
+    """
+    dtype = np.dtype([(name, dtype.fields[name][0]) for name in dtype.names
+                      if name in pytype.__slots__])
+    rosmsg = pytype()
+
+    def decode(datas):
+        values = []
+        for data in datas:
+            rosmsg.deserialize(data)
+            values.append(_genpy_values(rosmsg, dtype))
+        return np.array(values, dtype)
+    return decode
+
+
+def to_sec(stamps):
+    """Convert structured times to float seconds like genpy does."""
+    return (stamps['secs'].astype(np.float64) +
+            stamps['nsecs'].astype(np.float64) / 1e9)
@@ -26,7 +26,7 @@ import marv_nodes
 from marv_detail import make_map_dict
 from marv.types import Section, Widget
 from .bag import bagmeta
-from .cam import ffmpeg, images
+from .cam import camera_images, camera_videos, ffmpeg, sampled_images
 from .gnss import gnss_plots
 from .trajectory import trajectory
 
@@ -111,7 +111,7 @@ def gnss_section(plots, title):
 
 
 @marv.node(Widget)
-@marv.input('stream', foreach=images)  # images is a stream of streams of images
+@marv.input('stream', foreach=sampled_images)  # stream of streams of images
 def galleries(stream):
     """Galleries for all images streams.
 
@@ -145,6 +145,11 @@ def images_section(galleries, title):
         yield marv.push({'title': title, 'widgets': widgets})
 
 
+# Galleries and section for images of marv_robotics.cam.camera
+camera_galleries = galleries.clone(stream=camera_images)
+camera_images_section = images_section.clone(galleries=camera_galleries)
+
+
 @marv.node(Section)
 @marv.input('title', default='Connections')
 @marv.input('bagmeta', default=bagmeta)
@@ -228,7 +233,14 @@ def trajectory_section(geojson, title, minzoom, maxzoom, tile_server_protocol):
 @marv.input('title', default='Videos')
 @marv.input('videos', default=ffmpeg)
 def video_section(videos, title):
-    """Section displaying one video player per image stream."""
+    """Section displaying one video player per image stream.
+
+    DASH videos of :func:`marv_robotics.cam.ffmpeg` are displayed by
+    custom widgets of type ``dash_video``, with the relative paths of
+    manifest and WebVTT thumbnail track as JSON data.  The frontend
+    shipped with marv does not render these; sites enabling dash
+    need to provide a frontend with a DASH player for them.
+    """
     tmps = []
     while True:
         tmp = yield marv.pull(videos)
@@ -240,8 +252,32 @@ def video_section(videos, title):
         raise marv.Abort()
 
     videofiles = yield marv.pull_all(*videos)
-    widgets = [{'title': video.title, 'video': {'src': videofile.relpath}}
-               for video, videofile in zip(videos, videofiles)]
+    widgets = []
+    for video, videofile in zip(videos, videofiles):
+        if videofile is None:
+            continue
+        if not videofile.relpath.endswith('.mpd'):
+            widgets.append({'title': video.title,
+                            'video': {'src': videofile.relpath}})
+            continue
+
+        # DASH manifest, followed by its segments and a WebVTT track
+        # of thumbnails, not playable by the stock video widget
+        track = None
+        while True:
+            tmp = yield marv.pull(video)
+            if tmp is None:
+                break
+            if tmp.relpath.endswith('.vtt'):
+                track = tmp.relpath
+        data = {'src': videofile.relpath, 'track': track}
+        widgets.append({'title': video.title,
+                        'custom': {'type': 'dash_video',
+                                   'data': json.dumps(data, sort_keys=True)}})
     assert len(set(x['title'] for x in widgets)) == len(widgets)
     if widgets:
         yield marv.push({'title': title, 'widgets': widgets})
+
+
+# Section for videos of marv_robotics.cam.camera
+camera_video_section = video_section.clone(videos=camera_videos)
@@ -29,73 +29,55 @@ from matplotlib import pyplot as plt
 
 import marv
 from marv.types import File
-from .bag import get_message_type, messages
+from ._trampoline import trampoline
+from .bag import BATCH_SIZE, get_message_type, messages, pull_batch
+from .decode import PRIMITIVES, Unsupported, decoder, genpy_decoder, to_sec
+from .navsat import navsatfixes
 
-
-def yaw_angle(frame):
-    rot = np.zeros((3, 3))
-
-    # consists of time, x, y, z, w
-    q1 = frame.x
-    q2 = frame.y
-    q3 = frame.z
-    q4 = frame.w
-
-    rot[0, 0] = 1 - 2 * q2 * q2 - 2 * q3 * q3
-    rot[0, 1] = 2 * (q1 * q2 - q3 * q4)
-    rot[0, 2] = 2 * (q1 * q3 + q2 * q4)
-    rot[1, 0] = 2 * (q1 * q2 + q3 * q4)
-    rot[1, 1] = 1 - 2 * q1 * q1 - 2 * q3 * q3
-    rot[1, 2] = 2 * (q2 * q3 - q1 * q4)
-    rot[2, 0] = 2 * (q1 * q3 - q2 * q4)
-    rot[2, 1] = 2 * (q1 * q4 + q2 * q3)
-    rot[2, 2] = 1 - 2 * q1 * q1 - 2 * q2 * q2
-
-    vec = np.dot(rot, [1, 0, 0])
-    return np.arctan2(vec[1], vec[0])
+# Fields used, decoded by genpy_decoder if needed
+IMU = np.dtype([('header', [('stamp', PRIMITIVES['time'])]),
+                ('orientation', [('x', '<f8'), ('y', '<f8'), ('z', '<f8'),
+                                 ('w', '<f8')])])
+NAVSATORIENTATION = np.dtype([('header', [('stamp', PRIMITIVES['time'])]),
+                              ('yaw', '<f8')])
 
 
 @marv.node()
-@marv.input('stream', foreach=marv.select(messages, '*:sensor_msgs/NavSatFix'))
+@marv.input('stream', foreach=navsatfixes)
 def positions(stream):
-    yield marv.set_header(title=stream.topic)
-    pytype = get_message_type(stream)
-    rosmsg = pytype()
+    yield marv.set_header(title=stream.title)
     erroneous = 0
     e_offset = None
     n_offset = None
     u_offset = None
     positions = []
     while True:
-        msg = yield marv.pull(stream)
-        if msg is None:
+        fixes = yield marv.pull(stream)
+        if fixes is None:
             break
-        rosmsg.deserialize(msg.data)
-        if not hasattr(rosmsg, 'status') or \
-           np.isnan(rosmsg.longitude) or \
-           np.isnan(rosmsg.latitude) or \
-           np.isnan(rosmsg.altitude) or \
-           np.isnan(rosmsg.position_covariance[0]):
-            erroneous += 1
-            continue
-
-        e, n, _, _ = utm.from_latlon(rosmsg.longitude, rosmsg.latitude)
-        if e_offset is None:
-            e_offset = e
-            n_offset = n
-            u_offset = rosmsg.altitude
-        e = e - e_offset
-        n = n - n_offset
-        u = rosmsg.altitude - u_offset
-
-        # TODO: why do we accumulate?
-        positions.append([rosmsg.header.stamp.to_sec(),
-                          rosmsg.latitude,
-                          rosmsg.longitude,
-                          rosmsg.altitude,
-                          e, n, u,
-                          rosmsg.status.status,
-                          np.sqrt(rosmsg.position_covariance[0])])
+        valid = ~np.isnan(fixes['position_covariance'][:, 0])
+        erroneous += len(fixes) - np.count_nonzero(valid)
+        fixes = fixes[valid]
+
+        rows = zip(to_sec(fixes['header']['stamp']).tolist(),
+                   fixes['latitude'].tolist(),
+                   fixes['longitude'].tolist(),
+                   fixes['altitude'].tolist(),
+                   fixes['status']['status'].tolist(),
+                   np.sqrt(fixes['position_covariance'][:, 0]).tolist())
+        for stamp, latitude, longitude, altitude, status, deviation in rows:
+            e, n, _, _ = utm.from_latlon(longitude, latitude)
+            if e_offset is None:
+                e_offset = e
+                n_offset = n
+                u_offset = altitude
+            e = e - e_offset
+            n = n - n_offset
+            u = altitude - u_offset
+
+            # TODO: why do we accumulate?
+            positions.append([stamp, latitude, longitude, altitude,
+                              e, n, u, status, deviation])
     if erroneous:
         log = yield marv.get_logger()
         log.warn('skipped %d erroneous messages', erroneous)
@@ -103,55 +85,79 @@ def positions(stream):
         yield marv.push({'values': positions})
 
 
+def yaw_angles(orientations):
+    """Yaw angles of structured array of quaternions."""
+    q1 = orientations['x']
+    q2 = orientations['y']
+    q3 = orientations['z']
+    q4 = orientations['w']
+    return np.arctan2(2 * (q1 * q2 + q3 * q4), 1 - 2 * q2 * q2 - 2 * q3 * q3)
+
+
 @marv.node()
 @marv.input('stream', foreach=marv.select(messages, '*:sensor_msgs/Imu'))
+@trampoline
 def imus(stream):
     yield marv.set_header(title=stream.topic)
-    pytype = get_message_type(stream)
-    rosmsg = pytype()
+    try:
+        decode = decoder(stream.msg_type, stream.msg_type_def)
+    except Unsupported:
+        decode = genpy_decoder(get_message_type(stream), IMU)
     erroneous = 0
     imus = []
-    while True:
-        msg = yield marv.pull(stream)
-        if msg is None:
+    full = True
+    while full:
+        batch = []
+        yield pull_batch(stream, batch)
+        full = len(batch) == BATCH_SIZE
+        if not batch:
             break
-        rosmsg.deserialize(msg.data)
-        if np.isnan(rosmsg.orientation.x):
-            erroneous += 1
-            continue
+        msgs = decode(batch)
+        valid = ~np.isnan(msgs['orientation']['x'])
+        erroneous += len(msgs) - np.count_nonzero(valid)
+        msgs = msgs[valid]
 
         # TODO: why do we accumulate?
-        imus.append([rosmsg.header.stamp.to_sec(), yaw_angle(rosmsg.orientation)])
+        imus.extend(zip(to_sec(msgs['header']['stamp']).tolist(),
+                        yaw_angles(msgs['orientation']).tolist()))
     if erroneous:
         log = yield marv.get_logger()
         log.warn('skipped %d erroneous messages', erroneous)
-    yield marv.push({'values': imus})
+    yield marv.push({'values': [list(x) for x in imus]})
 
 
 @marv.node()
-@marv.input('stream', foreach=marv.select(messages, '*:nmea_navsat_driver/NavSatOrientation'))
+@marv.input('stream', foreach=marv.select(
+    messages, '*:nmea_navsat_driver/NavSatOrientation'))
+@trampoline
 def navsatorients(stream):
     log = yield marv.get_logger()
     yield marv.set_header(title=stream.topic)
-    pytype = get_message_type(stream)
-    rosmsg = pytype()
+    try:
+        decode = decoder(stream.msg_type, stream.msg_type_def)
+    except Unsupported:
+        decode = genpy_decoder(get_message_type(stream), NAVSATORIENTATION)
     erroneous = 0
     navsatorients = []
-    while True:
-        msg = yield marv.pull(stream)
-        if msg is None:
+    full = True
+    while full:
+        batch = []
+        yield pull_batch(stream, batch)
+        full = len(batch) == BATCH_SIZE
+        if not batch:
             break
 
-        rosmsg.deserialize(msg.data)
-        if np.isnan(rosmsg.yaw):
-            erroneous += 1
-            continue
+        msgs = decode(batch)
+        valid = ~np.isnan(msgs['yaw'])
+        erroneous += len(msgs) - np.count_nonzero(valid)
+        msgs = msgs[valid]
 
         # TODO: why do we accumulate?
-        navsatorients.append([rosmsg.header.stamp.to_sec(), rosmsg.yaw])
+        navsatorients.extend(zip(to_sec(msgs['header']['stamp']).tolist(),
+                                 msgs['yaw'].tolist()))
     if erroneous:
         log.warn('skipped %d erroneous messages', erroneous)
-    yield marv.push({'values': navsatorients})
+    yield marv.push({'values': [list(x) for x in navsatorients]})
 
 
 @marv.node(group=True)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2017 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Decoded navigation satellite messages shared by several nodes."""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+import marv
+from ._trampoline import trampoline
+from .bag import BATCH_SIZE, get_message_type, messages, pull_batch
+from .decode import PRIMITIVES, Unsupported, decoder, genpy_decoder
+
+# Fields used by consumers, decoded by genpy_decoder if needed
+NAVSATFIX = np.dtype([('header', [('stamp', PRIMITIVES['time'])]),
+                      ('status', [('status', 'i1')]),
+                      ('latitude', '<f8'),
+                      ('longitude', '<f8'),
+                      ('altitude', '<f8'),
+                      ('position_covariance', '<f8', (9,))])
+
+
+@marv.node()
+@marv.input('stream', foreach=marv.select(messages, '*:sensor_msgs/NavSatFix'))
+@trampoline
+def navsatfixes(stream):
+    """Decode sensor_msgs/NavSatFix messages once for all consumers.
+
+    Each message is a NumPy structured array with a batch of fixes as
+    returned by :func:`marv_robotics.decode.decoder`, or with the
+    fields of :data:`NAVSATFIX` for message definitions it does not
+    support.  Fixes lacking a status or with NaN longitude, latitude
+    or altitude are skipped.
+    """
+    yield marv.set_header(title=stream.topic)
+    try:
+        decode = decoder(stream.msg_type, stream.msg_type_def)
+    except Unsupported:
+        decode = genpy_decoder(get_message_type(stream), NAVSATFIX)
+    erroneous = 0
+    full = True
+    while full:
+        batch = []
+        yield pull_batch(stream, batch)
+        full = len(batch) == BATCH_SIZE
+        if not batch:
+            break
+        fixes = decode(batch)
+        if 'status' not in fixes.dtype.names:
+            erroneous += len(fixes)
+            continue
+        valid = ~(np.isnan(fixes['longitude']) |
+                  np.isnan(fixes['latitude']) |
+                  np.isnan(fixes['altitude']))
+        erroneous += len(fixes) - np.count_nonzero(valid)
+        if valid.any():
+            yield marv.push(fixes[valid])
+    if erroneous:
+        log = yield marv.get_logger()
+        log.warn('skipped %d erroneous messages', erroneous)
@@ -18,15 +18,56 @@
 
 from __future__ import absolute_import, division, print_function
 
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from collections import Counter
+
+import genpy
+import marv
+import mock
+import rosbag
+
 import marv_node.testing
 from marv_node.testing import make_dataset, make_sink, run_nodes, temporary_directory
 from marv_nodes import SetID
 from marv_store import Store
 from pkg_resources import resource_filename
 
+from marv_robotics import _cache, bag, bagfile
+from marv_robotics._trampoline import trampoline
 from marv_robotics.bag import bagmeta as node
 
 
+@marv.node()
+@marv.input('stream', default=marv.select(bag.multiplexed_messages, '*:*'))
+def multiplexed(stream):
+    yield marv.push({'start_time': stream.start_time,
+                     'end_time': stream.end_time,
+                     'msg_count': stream.msg_count})
+    while True:
+        msg = yield marv.pull(stream)
+        if msg is None:
+            break
+        yield marv.push({'topic': stream.topics[msg.tidx]['name'],
+                         'timestamp': msg.timestamp})
+
+
+@marv.node()
+@marv.input('stream', default=marv.select(bag.messages, '/chatter'))
+@trampoline
+def batched(stream):
+    full = True
+    while full:
+        batch = []
+        yield bag.pull_batch(stream, batch, size=7)
+        full = len(batch) == 7
+        if batch:
+            yield marv.push({'data': batch})
+
+
 # XXX: in what form do we need this test?
 
 class TestCase(marv_node.testing.TestCase):
@@ -43,3 +84,233 @@ class TestCase(marv_node.testing.TestCase):
             run_nodes(dataset, [sink], store)
             self.assertNodeOutput(sink.stream, node)
             # XXX: test also header
+
+    def test_multiplexed(self):
+        msgs = [(x.topic, x.timestamp.to_nsec())
+                for x in bag.read_messages(self.BAGS, chunkscan=True)]
+        with temporary_directory() as storedir:
+            store = Store(storedir, {})
+            dataset = make_dataset(self.BAGS)
+            store.add_dataset(dataset)
+            sink = make_sink(multiplexed)
+            run_nodes(dataset, [sink], store)
+        header = sink.stream[0]
+        self.assertEqual(header, {'start_time': msgs[0][1],
+                                  'end_time': msgs[-1][1],
+                                  'msg_count': len(msgs)})
+        self.assertEqual([(x['topic'], x['timestamp'])
+                          for x in sink.stream[1:]], msgs)
+
+    def test_pull_batch(self):
+        msgs = [bytes(x.message[1])
+                for x in bag.read_messages(self.BAGS, topics=['/chatter'])]
+        with temporary_directory() as storedir:
+            store = Store(storedir, {})
+            dataset = make_dataset(self.BAGS)
+            store.add_dataset(dataset)
+            sink = make_sink(batched)
+            run_nodes(dataset, [sink], store)
+        batches = [x['data'] for x in sink.stream]
+        self.assertTrue(all(len(x) == 7 for x in batches[:-1]))
+        self.assertEqual([bytes(x) for batch in batches for x in batch], msgs)
+
+
+class TestReadMessages(unittest.TestCase):
+    BAGS = TestCase.BAGS
+
+    def read_messages(self, *args, **kw):
+        """Return messages and paths of bags opened at most one at a time."""
+        opened = []
+        open_bags = set()
+
+        class Bag(rosbag.Bag):
+            def __init__(bag, path):
+                super(Bag, bag).__init__(path)
+                open_bags.add(bag)
+                opened.append(path)
+                self.assertEqual(len(open_bags), 1)
+
+            def close(bag):
+                open_bags.discard(bag)
+                super(Bag, bag).close()
+
+        orig, rosbag.Bag = rosbag.Bag, Bag
+        try:
+            msgs = list(bag.read_messages(*args, **kw))
+        finally:
+            rosbag.Bag = orig
+        self.assertFalse(open_bags)
+        return msgs, opened
+
+    def test_merge(self):
+        msgs, opened = self.read_messages(self.BAGS)
+        self.assertEqual(opened, self.BAGS)
+
+        expected = []
+        for path in self.BAGS:
+            with rosbag.Bag(path) as _bag:
+                expected.extend(_bag.read_messages(raw=True))
+        expected.sort(key=lambda x: x.timestamp)
+        self.assertEqual([(x.topic, x.message[1], x.timestamp)
+                          for x in msgs],
+                         [(x.topic, x.message[1], x.timestamp)
+                          for x in expected])
+
+    def test_chunkscan(self):
+        datadir = os.path.dirname(self.BAGS[0])
+        for name in sorted(os.listdir(datadir)):
+            if not name.endswith('.bag'):
+                continue
+            paths = [os.path.join(datadir, name)]
+            msgs, _ = self.read_messages(paths)
+            expected = [(x.topic, x.message[0], bytes(x.message[1]),
+                         x.message[2:4], x.timestamp) for x in msgs]
+            for workers in (1, 4):
+                chunkscan, opened = self.read_messages(paths, chunkscan=True,
+                                                       workers=workers)
+                self.assertEqual(opened, [])
+                self.assertEqual([(x.topic, x.message[0], bytes(x.message[1]),
+                                   x.message[2:4], x.timestamp)
+                                  for x in chunkscan], expected)
+
+    def test_time_window(self):
+        start_time = genpy.Time(1423137548, 500000000)
+        msgs, opened = self.read_messages(self.BAGS, start_time=start_time)
+        self.assertEqual(opened, self.BAGS[1:])
+        self.assertTrue(msgs)
+        self.assertTrue(all(x.timestamp >= start_time for x in msgs))
+
+
+class TestSelector(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(bag.parse_selector('/foo'),
+                         bag.Selector('/foo', None, None, None, None, None,
+                                      None))
+        self.assertEqual(bag.parse_selector('*:std_msgs/String'),
+                         bag.Selector('*', 'std_msgs/String', None, None,
+                                      None, None, None))
+        self.assertEqual(bag.parse_selector('/foo:*?start=10&end=20'),
+                         bag.Selector('/foo', '*', 10, 20, None, None, None))
+        self.assertEqual(bag.parse_selector('/foo?end=20&count=5'),
+                         bag.Selector('/foo', None, None, 20, None, 5, None))
+        self.assertEqual(bag.parse_selector('*:foo/A,foo/B?count=5'),
+                         bag.Selector('*', 'foo/A,foo/B', None, None, None,
+                                      5, None))
+        self.assertEqual(bag.parse_selector('/foo?every=2').every, 2)
+        self.assertEqual(bag.parse_selector('/foo?interval=100').interval, 100)
+        with self.assertRaises(ValueError):
+            bag.parse_selector('/foo?begin=10')
+        with self.assertRaises(ValueError):
+            bag.parse_selector('/foo?start')
+        with self.assertRaises(ValueError):
+            bag.parse_selector('/foo?every=2&count=5')
+        with self.assertRaises(ValueError):
+            bag.parse_selector('/foo?every=0')
+
+    def test_sample(self):
+        times = [x.timestamp.to_nsec()
+                 for x in bag.read_messages(TestCase.BAGS, topics=['/chatter'])]
+        for query, expected, step in [('every=3', times[::3], 3),
+                                      ('count=10', times[::3], 3),
+                                      ('count=100', times, 1),
+                                      ('interval=1000000000',
+                                       [times[0], times[10], times[20]], None)]:
+            selector = bag.parse_selector('/chatter?' + query)
+            sample, chunks, every = bag._sample(TestCase.BAGS, '/chatter',
+                                                selector, 0, sys.maxint)
+            self.assertEqual([x[0] for x in sample], expected, query)
+            self.assertEqual(sorted(chunks), TestCase.BAGS)
+            self.assertEqual(every, step, query)
+
+        msgs = bag.read_messages(TestCase.BAGS, topics=['/chatter'],
+                                 chunkscan=True)
+        selector = bag.parse_selector('/chatter?every=3')
+        sample, _, _ = bag._sample(TestCase.BAGS, '/chatter', selector,
+                                   0, sys.maxint)
+        expected = [(x.timestamp.to_nsec(), x.message[3]) for x in msgs]
+        self.assertEqual(sample, expected[::3])
+
+    def test_index_entries(self):
+        msgs = bag.read_messages(TestCase.BAGS[:1], topics=['/chatter'])
+        expected = [(x.timestamp.to_nsec(), x.message[3]) for x in msgs]
+        path = TestCase.BAGS[0]
+        entries = bag._index_entries(path, ['/chatter'], 0, sys.maxint)
+        self.assertEqual(entries, expected)
+        # rosbag fallback yields positions of rosbag's raw messages
+        with mock.patch.object(bagfile, 'read_index',
+                               side_effect=bagfile.Unsupported):
+            entries = bag._index_entries(path, ['/chatter'], 0, sys.maxint)
+        self.assertEqual(entries, expected)
+
+    def test_window_index(self):
+        start_time = 1423137548000000000
+        end_time = 1423137549000000000
+        topics = ['/chatter', '/rosout']
+        counts, chunks = bag._window_index(TestCase.BAGS, topics,
+                                           start_time, end_time)
+        msgs = list(bag.read_messages(TestCase.BAGS, topics=topics,
+                                      start_time=genpy.Time(1423137548),
+                                      end_time=genpy.Time(1423137549)))
+        self.assertEqual(counts, Counter(x.topic for x in msgs))
+        windowed = bag.read_messages(TestCase.BAGS, topics=topics,
+                                     start_time=genpy.Time(1423137548),
+                                     end_time=genpy.Time(1423137549),
+                                     chunkscan=True, chunks=chunks)
+        self.assertEqual([(x.topic, x.timestamp) for x in windowed],
+                         [(x.topic, x.timestamp) for x in msgs])
+
+        counts, chunks = bag._window_index(TestCase.BAGS, ['/chatter'], 0, 1)
+        self.assertEqual((counts, chunks), ({}, {}))
+
+    def test_segment_times(self):
+        times = [x.timestamp.to_nsec()
+                 for x in bag.read_messages(TestCase.BAGS, topics=['/chatter'])]
+        for segments in (1, 3, 100):
+            windows = bag.segment_times(TestCase.BAGS, '/chatter', segments)
+            self.assertLessEqual(len(windows), segments)
+            self.assertEqual(windows[0][0], times[0])
+            self.assertEqual(windows[-1][1], times[-1])
+            self.assertEqual(sorted(x for start, end in windows for x in times
+                                    if start <= x <= end), times)
+        self.assertEqual(bag.segment_times(TestCase.BAGS, '/nonexistent', 3),
+                         [])
+
+        windows = bag.segment_times(TestCase.BAGS, '/chatter', 3, align=4)
+        self.assertTrue(all(times.index(start) % 4 == 0
+                            for start, _ in windows))
+
+
+class TestMessageType(unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.orig_cachedir = _cache.CACHEDIR
+        _cache.CACHEDIR = self.cachedir
+        bag._message_types.clear()
+
+    def tearDown(self):
+        _cache.CACHEDIR = self.orig_cachedir
+        bag._message_types.clear()
+        shutil.rmtree(self.cachedir)
+
+    def test_cache(self):
+        with rosbag.Bag(TestCase.BAGS[0]) as _bag:
+            info = next(x for x in _bag._connections.values()
+                        if x.topic == '/chatter')
+            _, (_, data, _, _, _), _ = next(_bag.read_messages(['/chatter'],
+                                                               raw=True))
+
+        pytype = bag._message_type(info)
+        self.assertIs(bag._message_type(info), pytype)
+        self.assertTrue(os.listdir(self.cachedir))
+
+        # Fresh process, class is created from cached source
+        bag._message_types.clear()
+        orig, bag._get_message_type = bag._get_message_type, None
+        try:
+            cached = bag._message_type(info)
+        finally:
+            bag._get_message_type = orig
+        self.assertIsNot(cached, pytype)
+        self.assertEqual(cached._md5sum, info.md5sum)
+        self.assertEqual(cached().deserialize(data).data,
+                         pytype().deserialize(data).data)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+
+import bz2
+import mmap
+import os
+import unittest
+
+import rosbag
+from pkg_resources import resource_filename
+
+from marv_robotics import bagfile
+
+
+DATADIR = resource_filename('marv_robotics.tests', 'data')
+BAGS = sorted(os.path.join(DATADIR, x) for x in os.listdir(DATADIR)
+              if x.endswith('.bag'))
+
+
+class TestCase(unittest.TestCase):
+    def test_read_index(self):
+        for path in BAGS:
+            with open(path, 'rb') as f:
+                index = bagfile.read_index(f)
+            with rosbag.Bag(path) as bag:
+                self.assertEqual(
+                    [(x.id, x.topic, x.datatype, x.md5sum, x.msg_def, x.header)
+                     for x in index.connections.values()],
+                    [(x.id, x.topic, x.datatype, x.md5sum, x.msg_def, x.header)
+                     for x in bag._connections.values()])
+                self.assertEqual(
+                    [(x.pos, x.start_time, x.end_time, x.connection_counts)
+                     for x in index.chunks],
+                    [(x.pos, x.start_time.to_nsec(), x.end_time.to_nsec(),
+                      x.connection_counts)
+                     for x in bag._chunks])
+
+    def test_connection_stats(self):
+        for path in BAGS:
+            with open(path, 'rb') as f:
+                index = bagfile.read_index(f)
+                chunks = [bagfile.read_chunk_index(f, x) for x in index.chunks]
+                stats = bagfile.connection_stats(index.connections, chunks)
+                expected = {}
+                for chunk in chunks:
+                    f.seek(chunk.data_pos)
+                    data = f.read(chunk.data_len)
+                    if chunk.compression == b'bz2':
+                        data = bz2.decompress(data)
+                    for header, start, end in bagfile.iter_records(data):
+                        if ord(header[b'op']) != bagfile.OP_MSG_DATA:
+                            continue
+                        conid, = bagfile.UINT32.unpack(header[b'conn'])
+                        time = bagfile.to_nsec(
+                            *bagfile.TIME.unpack(header[b'time']))
+                        first, last, size = expected.get(conid, (time, time, 0))
+                        expected[conid] = bagfile.ConnectionStats(
+                            min(first, time), max(last, time),
+                            size + end - start)
+            self.assertEqual(stats, expected)
+
+    def test_read_messages(self):
+        for path in BAGS:
+            with open(path, 'rb') as f:
+                index = bagfile.read_index(f)
+                chunks = [bagfile.read_chunk_index(f, x) for x in index.chunks]
+                expected = sorted((time, chunk.info.pos, offset)
+                                  for chunk in chunks
+                                  for entries in chunk.entries.values()
+                                  for time, offset in entries)
+                msgs = [(x.conid, x.time, bytes(x.data), x.pos)
+                        for x in bagfile.read_messages(f, index)]
+                self.assertEqual([(x[1],) + x[3] for x in msgs], expected)
+
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                mapped_msgs = bagfile.read_messages(mapped, index)
+                self.assertEqual([(x.conid, x.time, bytes(x.data), x.pos)
+                                  for x in mapped_msgs], msgs)
+
+    def test_unsupported(self):
+        with open(__file__, 'rb') as f:
+            with self.assertRaises(bagfile.Unsupported):
+                bagfile.read_index(f)
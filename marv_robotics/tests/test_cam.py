@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from marv_robotics import cam
+
+CompressedImage = namedtuple('CompressedImage', '_type format data')
+Image = namedtuple('Image', '_type encoding width height')
+Stream = namedtuple('Stream', 'topic msg_count')
+SampledStream = namedtuple('SampledStream', 'topic msg_count every')
+
+
+def encode(ext, width=640, height=480):
+    img = np.zeros((height, width, 3), np.uint8)
+    img[::2, ::3] = 255
+    ok, data = cv2.imencode(ext, img)
+    assert ok
+    return data.tobytes()
+
+
+class TestImages(unittest.TestCase):
+    def test_image_size(self):
+        jpeg = encode('.jpg', 640, 480)
+        png = encode('.png', 320, 200)
+        self.assertEqual(cam.image_size(jpeg), (640, 480))
+        self.assertEqual(cam.image_size(png), (320, 200))
+
+        # Truncated within header, broken and other data
+        self.assertIsNone(cam.image_size(jpeg[:2]))
+        self.assertIsNone(cam.image_size(jpeg[:20]))
+        self.assertIsNone(cam.image_size(png[:8]))
+        self.assertIsNone(cam.image_size(png[:20]))
+        self.assertIsNone(cam.image_size(b'\xff\xd8\x00\x00' + jpeg[4:]))
+        self.assertIsNone(cam.image_size(b''))
+        self.assertIsNone(cam.image_size(b'GIF89a' + b'\x00' * 20))
+
+        # Truncated after header
+        self.assertEqual(cam.image_size(png[:24]), (320, 200))
+
+    def test_decode_thumbnail(self):
+        jpeg = encode('.jpg', 640, 480)
+        png = encode('.png', 640, 480)
+        for data in (jpeg, png):
+            for width, shape in [(320, (240, 320, 3)),
+                                 (100, (120, 160, 3)),
+                                 (80, (60, 80, 3)),
+                                 (640, (480, 640, 3)),
+                                 (1000, (480, 640, 3))]:
+                self.assertEqual(cam._decode_thumbnail(data, width).shape,
+                                 shape)
+
+        # Truncated or broken data is not decoded
+        self.assertIsNone(cam._decode_thumbnail(png[:24], 80))
+        self.assertIsNone(cam._decode_thumbnail(b'\x00' * 16, 80))
+
+    def test_thumbnail_template(self):
+        # Digits suffice for indexes within the topic, also if sampled
+        template = cam._thumbnail_template(Stream('/cam/image', 1000))
+        self.assertEqual(template.format(980), 'cam:image-980.jpg')
+        template = cam._thumbnail_template(SampledStream('/cam/image', 50, 20))
+        self.assertEqual(template.format(980), 'cam:image-980.jpg')
+        template = cam._thumbnail_template(SampledStream('/cam/image', 1, None))
+        self.assertEqual(template.format(0), 'cam:image-0.jpg')
+
+    def test_unsupported(self):
+        def compressed(fmt):
+            return CompressedImage(cam.COMPRESSED, fmt, b'')
+
+        self.assertFalse(cam._unsupported(compressed('jpeg')))
+        self.assertFalse(cam._unsupported(
+            compressed('rgb8; png compressed bgr8')))
+        self.assertTrue(cam._unsupported(
+            compressed('16UC1; compressedDepth')))
+
+
+class TestVideo(unittest.TestCase):
+    def test_video_size(self):
+        self.assertEqual(cam.video_size(640, 480), (1, 640, 480))
+        self.assertEqual(cam.video_size(640, 480, 640, 480), (1, 640, 480))
+        self.assertEqual(cam.video_size(641, 481), (1, 641, 481))
+        self.assertEqual(cam.video_size(640, 480, 320), (2, 320, 240))
+        self.assertEqual(cam.video_size(640, 480, 0, 240), (2, 320, 240))
+        self.assertEqual(cam.video_size(640, 480, 639), (2, 320, 240))
+        self.assertEqual(cam.video_size(640, 480, 320, 100), (5, 128, 96))
+        self.assertEqual(cam.video_size(1000, 750, 300), (4, 250, 186))
+        self.assertEqual(cam.video_size(2000, 1000, 100, 100), (20, 100, 50))
+
+    def test_decimated(self):
+        def image(encoding):
+            return Image('sensor_msgs/Image', encoding, 640, 480)
+
+        self.assertTrue(cam._decimated(image('rgb8')))
+        self.assertTrue(cam._decimated(image('32FC1')))
+        self.assertFalse(cam._decimated(image('bayer_rggb8')))
+        self.assertFalse(cam._decimated(CompressedImage(cam.COMPRESSED, 'jpeg',
+                                                        b'')))
+
+
+class TestDash(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_output_args(self):
+        self.assertEqual(cam._output_args('/x/v.webm', 0), ['-y', '/x/v.webm'])
+        self.assertEqual(cam._output_args('/x/v.webm', 4), ['-y', '/x/v.webm'])
+
+        args = cam._output_args('/x/v.mpd', 4)
+        self.assertEqual(args[:2], ['-f', 'dash'])
+        self.assertEqual(args[args.index('-seg_duration') + 1], '4')
+        self.assertEqual(args[args.index('-init_seg_name') + 1], 'v-init.webm')
+        self.assertEqual(args[args.index('-media_seg_name') + 1],
+                         'v-$Number%05d$.webm')
+        self.assertEqual(args[args.index('-y') + 1], '/x/v.mpd')
+        self.assertEqual(args[args.index('-vf') + 1],
+                         'fps=1/10,scale=160:-2,tile=10x10')
+        self.assertEqual(args[-2:], ['-y', '/x/v-sprite-%03d.jpg'])
+
+    def test_vtt_time(self):
+        self.assertEqual(cam._vtt_time(0), '00:00:00.000')
+        self.assertEqual(cam._vtt_time(9.5), '00:00:09.500')
+        self.assertEqual(cam._vtt_time(61.25), '00:01:01.250')
+        self.assertEqual(cam._vtt_time(3725), '01:02:05.000')
+
+    def cues(self, duration):
+        manifest = os.path.join(self.tmpdir, 'v.mpd')
+        track = os.path.join(self.tmpdir, 'v.vtt')
+        cam._write_sprite_track(track, manifest, duration)
+        with open(track) as f:
+            lines = f.read().split('\n')
+        self.assertEqual(lines[0], 'WEBVTT')
+        return [tuple(lines[idx:idx + 2])
+                for idx in range(2, len(lines) - 1, 3)]
+
+    def test_write_sprite_track(self):
+        self.assertEqual(self.cues(25), [])
+
+        # One sprite of 10x10 thumbnails of 16x9 pixels
+        sprite = os.path.join(self.tmpdir, 'v-sprite-001.jpg')
+        cv2.imwrite(sprite, np.zeros((90, 160, 3), np.uint8))
+        self.assertEqual(self.cues(0), [])
+        self.assertEqual(self.cues(25), [
+            ('00:00:00.000 --> 00:00:10.000',
+             'v-sprite-001.jpg#xywh=0,0,16,9'),
+            ('00:00:10.000 --> 00:00:20.000',
+             'v-sprite-001.jpg#xywh=16,0,16,9'),
+            ('00:00:20.000 --> 00:00:25.000',
+             'v-sprite-001.jpg#xywh=32,0,16,9'),
+        ])
+        self.assertEqual(self.cues(0.5), [
+            ('00:00:00.000 --> 00:00:00.500', 'v-sprite-001.jpg#xywh=0,0,16,9'),
+        ])
+
+        # Cues are limited to thumbnails of existing sprites
+        cues = self.cues(2000)
+        self.assertEqual(len(cues), 100)
+        self.assertEqual(cues[11], ('00:01:50.000 --> 00:02:00.000',
+                                    'v-sprite-001.jpg#xywh=16,9,16,9'))
+        self.assertEqual(cues[-1], ('00:16:30.000 --> 00:16:40.000',
+                                    'v-sprite-001.jpg#xywh=144,81,16,9'))
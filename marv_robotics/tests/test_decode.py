@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+import numpy as np
+import rosbag
+from pkg_resources import resource_filename
+
+from marv_robotics import decode
+
+
+class TestCase(unittest.TestCase):
+    def read(self, name):
+        path = resource_filename('marv_robotics.tests', 'data/{}'.format(name))
+        with rosbag.Bag(path) as bag:
+            msgs = list(bag.read_messages(raw=True))
+        datatype, _, md5sum, _, pytype = msgs[0].message
+        con = next(x for x in bag._connections.values() if x.md5sum == md5sum)
+        return con, [x.message[1] for x in msgs], pytype
+
+    def test_navsatfix(self):
+        con, datas, pytype = self.read('navsatfix.bag')
+        fixes = decode.decoder(con.datatype, con.msg_def)(datas)
+        self.assertEqual(len(fixes), len(datas))
+        stamps = decode.to_sec(fixes['header']['stamp'])
+        for fix, stamp, data in zip(fixes, stamps, datas):
+            msg = pytype().deserialize(data)
+            self.assertEqual(stamp, msg.header.stamp.to_sec())
+            self.assertEqual(fix['header']['seq'], msg.header.seq)
+            self.assertEqual(fix['header']['frame_id'], msg.header.frame_id)
+            self.assertEqual(fix['status']['status'], msg.status.status)
+            self.assertEqual(fix['latitude'], msg.latitude)
+            self.assertEqual(fix['longitude'], msg.longitude)
+            self.assertEqual(fix['altitude'], msg.altitude)
+            self.assertEqual(fix['position_covariance'].tolist(),
+                             list(msg.position_covariance))
+
+    def test_frame_id_lengths(self):
+        con, datas, _ = self.read('navsatfix.bag')
+        header = datas[0][:12]
+        rest = datas[0][16 + len(b'zeno_gps_antenna_frame'):]
+        datas = [header + b'\x01\x00\x00\x00a' + rest,
+                 header + b'\x00\x00\x00\x00' + rest,
+                 header + b'\x03\x00\x00\x00abc' + rest]
+        fixes = decode.decoder(con.datatype, con.msg_def)(datas)
+        self.assertEqual(fixes['header']['frame_id'].tolist(),
+                         [b'a', b'', b'abc'])
+        self.assertTrue(np.all(fixes['latitude'] == fixes['latitude'][0]))
+
+    def test_genpy_decoder(self):
+        con, datas, pytype = self.read('navsatfix.bag')
+        dtype = np.dtype([('header', [('stamp', decode.PRIMITIVES['time'])]),
+                          ('latitude', '<f8'),
+                          ('position_covariance', '<f8', (9,)),
+                          ('missing', '<f8')])
+        fixes = decode.decoder(con.datatype, con.msg_def)(datas)
+        decoded = decode.genpy_decoder(pytype, dtype)(datas)
+        self.assertEqual(decoded.dtype.names,
+                         ('header', 'latitude', 'position_covariance'))
+        self.assertEqual(decoded['header']['stamp'].tolist(),
+                         fixes['header']['stamp'].tolist())
+        self.assertEqual(decoded['latitude'].tolist(),
+                         fixes['latitude'].tolist())
+        self.assertEqual(decoded['position_covariance'].tolist(),
+                         fixes['position_covariance'].tolist())
+
+    def test_unsupported(self):
+        con, _, _ = self.read('test_0.bag')
+        with self.assertRaises(decode.Unsupported):
+            decode.decoder(con.datatype, con.msg_def)
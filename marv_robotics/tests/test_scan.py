@@ -18,10 +18,27 @@
 
 from __future__ import absolute_import, division, print_function
 
+import inspect
+import os
+import shutil
+import tempfile
 import unittest
 
+import marv.app
+import marv.model
+from flask import Flask
+from marv.model import db
 from marv.scanner import DatasetInfo as DSI
-from marv_robotics.bag import scan
+from marv.site import Site
+from marv_robotics import _cache
+from marv_robotics.bag import cached_scan, scan
+
+VISITED = []
+
+
+def recording_scan(dirpath, dirnames, filenames):
+    VISITED.append(dirpath)
+    return cached_scan(dirpath, dirnames, filenames)
 
 
 class TestCase(unittest.TestCase):
@@ -101,3 +118,168 @@ class TestCase(unittest.TestCase):
             DSI(name='foo_0000-11-00-00-00-00', files=['foo_0000-11-00-00-00-00.bag']),
             DSI(name='foo_0000-22-00-00-00-00', files=['foo_0000-22-00-00-00-00.bag']),
         ])
+
+
+class TouchMixin(object):
+    def touch(self, *names):
+        self.mtime = getattr(self, 'mtime', 0) + 1
+        for name in names:
+            path = os.path.join(self.scanroot, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        # Pretend modified directories are old enough to be cached
+        for dirpath, _, _ in os.walk(self.scanroot):
+            if os.stat(dirpath).st_mtime > 1000:
+                os.utime(dirpath, (self.mtime, self.mtime))
+
+
+class TestCachedScan(TouchMixin, unittest.TestCase):
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.scanroot = tempfile.mkdtemp()
+        self.orig_cachedir = _cache.CACHEDIR
+        _cache.CACHEDIR = self.cachedir
+        self.known = {}
+
+    def tearDown(self):
+        _cache.CACHEDIR = self.orig_cachedir
+        shutil.rmtree(self.cachedir)
+        shutil.rmtree(self.scanroot)
+
+    def walk(self, dburi='sqlite://', dry_run=False, top='', stop=None):
+        # Mimic marv.collection.Collection.scan, known files are not
+        # passed to the scanner.
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = dburi
+        known = self.known.setdefault(dburi, set())
+        visited = []
+        with app.app_context():
+            walkroot = os.path.join(self.scanroot, top)
+            for dirpath, dirnames, filenames in os.walk(walkroot):
+                dirnames.sort()
+                visited.append(os.path.relpath(dirpath, self.scanroot))
+                if visited[-1] == stop:
+                    break
+                filenames = sorted(x for x in filenames
+                                   if os.path.join(dirpath, x) not in known)
+                for _, files in cached_scan(dirpath, dirnames, filenames):
+                    if not dry_run:
+                        known.update(os.path.join(dirpath, x) for x in files)
+        return visited
+
+    def test_skip_unchanged(self):
+        self.touch('a/foo.bag', 'b/c/bar.bag')
+        self.assertEqual(self.walk(), ['.', 'a', 'b', 'b/c'])
+        # Added datasets are skipped only once they are known
+        self.assertEqual(self.walk(), ['.', 'a', 'b', 'b/c'])
+        self.assertEqual(self.walk(), ['.'])
+        self.touch('b/c/baz.bag')
+        self.assertEqual(self.walk(), ['.', 'b', 'b/c'])
+        self.assertEqual(self.walk(), ['.', 'b', 'b/c'])
+        self.assertEqual(self.walk(), ['.'])
+
+    def test_skip_only_known(self):
+        self.touch('a/foo.bag', 'b/bar.bag')
+        self.assertEqual(self.walk(dry_run=True), ['.', 'a', 'b'])
+        self.assertEqual(self.walk(dry_run=True), ['.', 'a', 'b'])
+        self.assertEqual(self.walk(), ['.', 'a', 'b'])
+        self.assertEqual(self.walk(), ['.', 'a', 'b'])
+        self.assertEqual(self.walk(), ['.'])
+        self.assertEqual(self.walk(dburi='sqlite:///other'), ['.', 'a', 'b'])
+        self.assertEqual(self.walk(dburi='sqlite:///other'), ['.', 'a', 'b'])
+        self.assertEqual(self.walk(dburi='sqlite:///other'), ['.'])
+        self.assertEqual(self.walk(), ['.'])
+
+    def test_scan_subdirectory(self):
+        self.touch('a/foo.bag', 'a/b/bar.bag', 'c/baz.bag')
+        for _ in range(3):
+            self.walk()
+        self.assertEqual(self.walk(), ['.'])
+        self.touch('a/b/d/new.bag')
+        self.assertEqual(self.walk(top='a'), ['a', 'a/b', 'a/b/d'])
+        self.assertEqual(self.walk(top='a'), ['a', 'a/b', 'a/b/d'])
+        self.assertEqual(self.walk(top='a'), ['a'])
+        self.touch('a/b/d/e/newer.bag')
+        self.assertEqual(self.walk(top='a/b'), ['a/b', 'a/b/d', 'a/b/d/e'])
+        self.assertEqual(self.walk(top='a/b'), ['a/b', 'a/b/d', 'a/b/d/e'])
+        self.assertEqual(self.walk(top='a/b'), ['a/b'])
+        self.assertEqual(self.walk(), ['.'])
+
+    def test_interrupted_scan(self):
+        self.touch('a/b/foo.bag', 'a/c/bar.bag')
+        for _ in range(3):
+            self.walk()
+        # Scan stops after finding b unchanged and c changed
+        os.utime(os.path.join(self.scanroot, 'a', 'c'), (0, 0))
+        self.assertEqual(self.walk(stop='a'), ['.', 'a'])
+        self.touch('a/b/baz.bag')
+        self.assertEqual(self.walk(top='a'), ['a', 'a/b', 'a/c'])
+
+    def test_no_app_context(self):
+        self.touch('a/foo.bag')
+        for _ in range(2):
+            visited = []
+            for dirpath, dirnames, filenames in os.walk(self.scanroot):
+                visited.append(os.path.relpath(dirpath, self.scanroot))
+                rv = cached_scan(dirpath, dirnames, sorted(filenames))
+            self.assertEqual(visited, ['.', 'a'])
+            self.assertEqual(rv, [DSI(name='foo', files=['foo.bag'])])
+
+
+class TestCachedScanSite(TouchMixin, unittest.TestCase):
+    CONFIG = """
+    [marv]
+    collections = bags
+
+    [collection bags]
+    scanner = marv_robotics.tests.test_scan:recording_scan
+    scanroots = scanroot
+    """
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.orig_cachedir = _cache.CACHEDIR
+        _cache.CACHEDIR = self.cachedir
+        self.sitedir = tempfile.mkdtemp()
+        self.scanroot = os.path.join(self.sitedir, 'scanroot')
+        os.mkdir(self.scanroot)
+        siteconf = os.path.join(self.sitedir, 'marv.conf')
+        with open(siteconf, 'w') as f:
+            f.write(inspect.cleandoc(self.CONFIG))
+        marv.model._LISTING_PREFIX = 'test_scan_'
+        self.site = Site(siteconf)
+        self.appctx = marv.app.create_app(self.site).app_context()
+        self.appctx.push()
+        self.site.init()
+        self.collection = self.site.collections['bags']
+
+    def tearDown(self):
+        self.appctx.pop()
+        db.session.remove()
+        for table in [v for k, v in db.metadata.tables.items()
+                      if k.startswith('test_scan_')]:
+            db.metadata.remove(table)
+        _cache.CACHEDIR = self.orig_cachedir
+        shutil.rmtree(self.cachedir)
+        shutil.rmtree(self.sitedir)
+
+    def scan(self, path=''):
+        del VISITED[:]
+        scanpath = os.path.join(self.scanroot, path) if path else self.scanroot
+        self.collection.scan(scanpath)
+        return [os.path.relpath(x, self.scanroot) for x in VISITED]
+
+    def test_scan(self):
+        self.touch('a/foo.bag', 'a/b/bar.bag', 'c/baz.bag')
+        self.assertEqual(self.scan(), ['.', 'a', 'a/b', 'c'])
+        self.assertEqual(self.scan(), ['.', 'a', 'a/b', 'c'])
+        self.assertEqual(self.scan(), ['.'])
+        self.assertEqual(len(self.site.query()), 3)
+
+        self.touch('a/b/d/new.bag')
+        self.assertEqual(self.scan('a'), ['a', 'a/b', 'a/b/d'])
+        self.assertEqual(self.scan('a'), ['a', 'a/b', 'a/b/d'])
+        self.assertEqual(self.scan('a'), ['a'])
+        self.assertEqual(self.scan(), ['.'])
+        self.assertEqual(len(self.site.query()), 4)
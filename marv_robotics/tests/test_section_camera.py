@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+
+import cv2
+import genpy.dynamic
+import marv
+import numpy as np
+import rosbag
+
+import marv_node.testing
+from marv.types import File
+from marv_node.testing import make_dataset, make_sink, run_nodes
+from marv_node.testing import temporary_directory
+from marv_store import Store
+
+from marv_robotics.bag import messages
+from marv_robotics.cam import camera, camera_images, camera_videos
+from marv_robotics.cam import ffmpeg, ffmpeg_segmented
+from marv_robotics.detail import camera_images_section, camera_video_section
+from marv_robotics.detail import galleries, images_section, video_section
+
+COMPRESSED_IMAGE = """\
+Header header
+string format
+uint8[] data
+
+================================================================================
+MSG: std_msgs/Header
+uint32 seq
+time stamp
+string frame_id
+"""
+CompressedImage = genpy.dynamic.generate_dynamic(
+    'sensor_msgs/CompressedImage', COMPRESSED_IMAGE)[
+        'sensor_msgs/CompressedImage']
+
+
+@marv.node(File)
+@marv.input('stream', foreach=marv.select(messages,
+                                          '*:sensor_msgs/CompressedImage'))
+def thumbnails(stream):
+    """Images like camera, but without video."""
+    yield marv.set_header(title=stream.topic)
+    for idx in range(2):
+        imgfile = yield marv.make_file('image-{}.jpg'.format(idx))
+        yield imgfile
+
+
+thumbnail_video_section = video_section.clone(
+    videos=camera_videos.clone(stream=thumbnails))
+thumbnail_images_section = images_section.clone(
+    galleries=galleries.clone(stream=camera_images.clone(stream=thumbnails)))
+
+dash = ffmpeg.clone(dash=True, dash_segment_duration=2)
+dash_segmented = ffmpeg_segmented.clone(dash=True, dash_segment_duration=2,
+                                        segments=2)
+
+PERSIST = {camera.name: camera, thumbnails.name: thumbnails,
+           'dash': dash, 'dash_segmented': dash_segmented}
+
+
+def make_bag(path, frames):
+    """Write frames to /cam/image of bag at path, one per second."""
+    with rosbag.Bag(path, 'w') as bag:
+        for idx, data in enumerate(frames):
+            msg = CompressedImage(format='jpeg', data=data)
+            msg.header.stamp = genpy.Time(100 + idx)
+            bag.write('/cam/image', msg, msg.header.stamp)
+
+
+def encode_jpeg(value):
+    img = np.full((48, 64, 3), value, np.uint8)
+    ok, data = cv2.imencode('.jpg', img)
+    assert ok
+    return data.tobytes()
+
+
+class TestCase(marv_node.testing.TestCase):
+    def run_section(self, node, frames=None):
+        with temporary_directory() as tmpdir:
+            bagpath = os.path.join(tmpdir, 'cam.bag')
+            make_bag(bagpath, frames or [encode_jpeg(x * 30) for x in range(7)])
+            storedir = os.path.join(tmpdir, 'store')
+            os.mkdir(storedir)
+            store = Store(storedir, PERSIST)
+            dataset = make_dataset([bagpath])
+            store.add_dataset(dataset)
+            sink = make_sink(node)
+            run_nodes(dataset, [sink], store, PERSIST)
+        return [x.to_dict() for x in sink.stream]
+
+    def test_video(self):
+        sections = self.run_section(camera_video_section)
+        self.assertEqual(len(sections), 1)
+        widgets = sections[0]['widgets']
+        self.assertEqual([x['title'] for x in widgets], ['/cam/image'])
+        self.assertEqual(os.path.basename(widgets[0]['video']['src']),
+                         'cam_image.webm')
+
+    def test_images(self):
+        # Images failing to decode are skipped
+        frames = [encode_jpeg(x * 30) for x in range(7)]
+        frames[3] = b'\x00' * 16
+        sections = self.run_section(camera_images_section, frames)
+        self.assertEqual(len(sections), 1)
+        widgets = sections[0]['widgets']
+        self.assertEqual([x['title'] for x in widgets], ['/cam/image'])
+        self.assertEqual([os.path.basename(x['src'])
+                          for x in widgets[0]['gallery']['images']],
+                         ['cam:image-{}.jpg'.format(x)
+                          for x in (0, 1, 2, 4, 5, 6)])
+
+    def test_without_video(self):
+        # Images are told from videos by type, not by position
+        self.assertEqual(self.run_section(thumbnail_video_section), [])
+        sections = self.run_section(thumbnail_images_section)
+        images = sections[0]['widgets'][0]['gallery']['images']
+        self.assertEqual([os.path.basename(x['src']) for x in images],
+                         ['image-0.jpg', 'image-1.jpg'])
+
+    def test_dash(self):
+        for videos in (dash, dash_segmented):
+            node = video_section.clone(videos=videos)
+            sections = self.run_section(node)
+            widgets = sections[0]['widgets']
+            self.assertEqual([x['title'] for x in widgets], ['/cam/image'])
+            self.assertEqual(widgets[0]['custom']['type'], 'dash_video')
+            data = json.loads(widgets[0]['custom']['data'])
+            self.assertEqual(os.path.basename(data['src']), 'cam_image.mpd')
+            self.assertEqual(os.path.basename(data['track']), 'cam_image.vtt')
@@ -24,11 +24,11 @@ from marv_nodes import SetID
 from marv_store import Store
 from pkg_resources import resource_filename
 
-from marv_robotics.cam import images
+from marv_robotics.cam import sampled_images
 from marv_robotics.detail import images_section as node
 
 
-PERSIST = {images.name: images}
+PERSIST = {sampled_images.name: sampled_images}
 
 
 class TestCase(marv_node.testing.TestCase):
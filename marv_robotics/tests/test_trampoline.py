@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+
+import unittest
+
+from marv_robotics._trampoline import trampoline
+
+
+class TestTrampoline(unittest.TestCase):
+    def test_delegate(self):
+        log = []
+
+        def body(name):
+            value = yield name + '1'
+            log.append(value)
+            value = yield name + '2'
+            log.append(value)
+
+        @trampoline
+        def gen():
+            value = yield 'a'
+            log.append(value)
+            yield body('b')
+            yield body('c')
+            value = yield 'd'
+            log.append(value)
+
+        g = gen()
+        cmds = [next(g)]
+        for value in range(5):
+            cmds.append(g.send(value))
+        with self.assertRaises(StopIteration):
+            g.send(5)
+        self.assertEqual(cmds, ['a', 'b1', 'b2', 'c1', 'c2', 'd'])
+        self.assertEqual(log, [0, 1, 2, 3, 4, 5])
+
+    def test_throw_and_close(self):
+        log = []
+
+        def body():
+            try:
+                yield 'b1'
+            except KeyError:
+                log.append('caught')
+            try:
+                yield 'b2'
+            finally:
+                log.append('closed')
+
+        def failing():
+            yield 'f1'
+            raise KeyError('f')
+
+        @trampoline
+        def gen():
+            yield body()
+            try:
+                yield failing()
+            except KeyError:
+                log.append('raised')
+            yield 'c'
+
+        g = gen()
+        self.assertEqual(next(g), 'b1')
+        self.assertEqual(g.throw(KeyError), 'b2')
+        self.assertEqual(next(g), 'f1')
+        self.assertEqual(next(g), 'c')
+        self.assertEqual(log, ['caught', 'closed', 'raised'])
+
+        g = gen()
+        next(g)
+        next(g)
+        g.close()
+        self.assertEqual(log[3:], ['closed'])
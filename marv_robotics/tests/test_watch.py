@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from marv_robotics.watch import Inotify, IN_CLOSE_WRITE, IN_IGNORED
+from marv_robotics.watch import is_recording
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_inotify(self):
+        inotify = Inotify()
+        wd = inotify.add_watch(self.dirpath)
+        open(os.path.join(self.dirpath, 'foo.bag'), 'w').close()
+        events = inotify.read(1)
+        inotify.close()
+        self.assertIn((wd, IN_CLOSE_WRITE, 0, 'foo.bag'), events)
+
+    def test_is_recording(self):
+        path = os.path.join(self.dirpath, 'foo_1.bag.active')
+        open(path, 'w').close()
+        missing = os.path.join(self.dirpath, 'foo_0.bag.active')
+        self.assertTrue(is_recording([missing, path]))
+        os.utime(path, (0, 0))
+        self.assertFalse(is_recording([missing, path]))
+        self.assertFalse(is_recording([]))
+
+    def test_rm_watch(self):
+        inotify = Inotify()
+        wd = inotify.add_watch(self.dirpath)
+        inotify.rm_watch(wd)
+        inotify.rm_watch(wd)
+        open(os.path.join(self.dirpath, 'foo.bag'), 'w').close()
+        events = inotify.read(1)
+        inotify.close()
+        self.assertEqual([(wd, IN_IGNORED, 0, '')], events)
@@ -18,40 +18,31 @@
 
 from __future__ import absolute_import, division, print_function
 
-import numpy as np
-
 import marv
 from marv.types import File, GeoJson
-from .bag import get_message_type, messages
+from .decode import to_sec
+from .navsat import navsatfixes
 
 
 @marv.node()
-@marv.input('stream', foreach=marv.select(messages, '*:sensor_msgs/NavSatFix'))
+@marv.input('stream', foreach=navsatfixes)
 def navsatfix(stream):
-    yield marv.set_header(title=stream.topic)
-    pytype = get_message_type(stream)
-    rosmsg = pytype()
-    erroneous = 0
+    yield marv.set_header(title=stream.title)
     while True:
-        msg = yield marv.pull(stream)
-        if msg is None:
+        fixes = yield marv.pull(stream)
+        if fixes is None:
             break
-        rosmsg.deserialize(msg.data)
-        if not hasattr(rosmsg, 'status') or \
-           np.isnan(rosmsg.longitude) or \
-           np.isnan(rosmsg.latitude) or \
-           np.isnan(rosmsg.altitude):
-            erroneous += 1
-            continue
-        # TODO: namedtuple?
-        out = {'status': rosmsg.status.status,
-               'lon': rosmsg.longitude,
-               'lat': rosmsg.latitude,
-               'timestamp': rosmsg.header.stamp.to_time()}
-        yield marv.push(out)
-    if erroneous:
-        log = yield marv.get_logger()
-        log.warn('skipped %d erroneous messages', erroneous)
+        rows = zip(fixes['status']['status'].tolist(),
+                   fixes['longitude'].tolist(),
+                   fixes['latitude'].tolist(),
+                   to_sec(fixes['header']['stamp']).tolist())
+        for status, lon, lat, timestamp in rows:
+            # TODO: namedtuple?
+            out = {'status': status,
+                   'lon': lon,
+                   'lat': lat,
+                   'timestamp': timestamp}
+            yield marv.push(out)
 
 
 @marv.node(GeoJson)
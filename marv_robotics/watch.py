@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of MARV Robotics
+#
+# Copyright 2016-2018 Ternaris
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scan directories of scanroots as they change, based on Linux inotify."""
+
+from __future__ import absolute_import, division, print_function
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+from logging import getLogger
+
+from .bag import cached_scan
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_DELETE_SELF | \
+             IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+
+EVENT = struct.Struct('iIII')
+
+log = getLogger(__name__)
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper around the Linux inotify API."""
+
+    def __init__(self):
+        self._libc = libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                        use_errno=True)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self, path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # Fails for watches the kernel removed already, which is fine
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Return list of (wd, mask, cookie, name) events.
+
+        Block up to timeout seconds for events to arrive, forever if
+        timeout is None.
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+        if not readable:
+            return []
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, size = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset + size].rstrip(b'\0')
+            offset += size
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_recording(paths, stale=600):
+    """Whether any of the ``.bag.active`` files at paths is recorded to.
+
+    ``rosbag record`` writes to ``*.bag.active`` files and renames
+    them once a bag is finished.  Active files not modified for stale
+    seconds are considered leftovers of crashed recordings.
+    """
+    deadline = time.time() - stale
+    for path in paths:
+        try:
+            if os.stat(path).st_mtime > deadline:
+                return True
+        except OSError:
+            pass
+    return False
+
+
+def watch(site, settle=2., stale=600):
+    """Scan directories of all collections' scanroots as they change.
+
+    Directories are watched for files being created, finished,
+    moved and deleted.  Once a directory saw no events for settle
+    seconds, the collection it belongs to scans it with the
+    configured scanner.  marv scans the whole tree below a
+    directory, for scanroots that is the whole archive, as on
+    startup to catch up on changes.  Only with
+    :func:`marv_robotics.bag.cached_scan` as scanner are unchanged
+    subtrees skipped, at the cost of stat'ing their directories;
+    with other scanners a warning is logged.
+
+    Directories containing active recordings are held back until
+    the recording is finished, in order for split bag sets (e.g.
+    ``foo_0.bag``, ``foo_1.bag``, ...) to be added as one dataset
+    instead of individual bags.  Active recordings are tracked from
+    the events as well, no directory is walked to find them.
+
+    Args:
+        site: A :class:`marv.site.Site` within application context.
+        settle (float): Seconds without events before a directory
+            is scanned.
+        stale (float): Seconds after which ``.bag.active`` files are
+            considered leftovers of crashed recordings.
+    """
+    inotify = Inotify()
+    scanroots = {scanroot: collection
+                 for collection in site.collections.values()
+                 for scanroot in collection.scanroots}
+    watches = {}
+    pending = {}
+    active = set()
+
+    def add_tree(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            if os.path.exists(os.path.join(dirpath, '.marvignore')):
+                dirnames[:] = []
+                continue
+            dirnames[:] = sorted(x for x in dirnames if x[0] != '.')
+            try:
+                watches[inotify.add_watch(dirpath)] = dirpath
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    log.error('Out of inotify watches, consider increasing '
+                              'fs.inotify.max_user_watches')
+                    raise
+                log.warn('Could not watch %s: %s', dirpath, e)
+            active.update(os.path.join(dirpath, x) for x in filenames
+                          if x.endswith('.bag.active'))
+
+    def drop_tree(path):
+        # Watches of moved directories would report under stale paths
+        below = path + os.sep
+        for wd, dirpath in list(watches.items()):
+            if dirpath == path or dirpath.startswith(below):
+                inotify.rm_watch(wd)
+                del watches[wd]
+                pending.pop(dirpath, None)
+        active.difference_update([x for x in active if x.startswith(below)])
+
+    for name, collection in sorted(site.collections.items()):
+        if collection.scanner is not cached_scan:
+            log.warn('collection %s does not use '
+                     'marv_robotics.bag:cached_scan, changes will be '
+                     'scanned by walking whole trees', name)
+
+    now = time.time()
+    for scanroot in sorted(scanroots):
+        add_tree(scanroot)
+        pending[scanroot] = now  # catch up on changes since last scan
+    log.info('watching %d directories', len(watches))
+
+    try:
+        while True:
+            for wd, mask, _, name in inotify.read(settle if pending else None):
+                now = time.time()
+                if mask & IN_Q_OVERFLOW:
+                    log.warn('inotify queue overflow, rescanning everything')
+                    pending.update((x, now) for x in scanroots)
+                    continue
+                dirpath = watches.get(wd)
+                if dirpath is None:
+                    continue
+                if mask & (IN_IGNORED | IN_DELETE_SELF):
+                    drop_tree(dirpath)
+                    continue
+                path = os.path.join(dirpath, name)
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        drop_tree(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO) and name[0] != '.':
+                        add_tree(path)
+                elif name.endswith('.bag.active'):
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        active.add(path)
+                    elif mask & (IN_DELETE | IN_MOVED_FROM):
+                        active.discard(path)
+                pending[dirpath] = now
+
+            now = time.time()
+            for dirpath, timestamp in sorted(pending.items()):
+                if dirpath not in pending:
+                    continue
+                below = dirpath + os.sep
+                active_below = [x for x in active if x.startswith(below)]
+                if now - timestamp < settle or \
+                   is_recording(active_below, stale):
+                    continue
+                del pending[dirpath]
+                # Subdirectories are scanned along with their parent
+                for other in [x for x in pending if x.startswith(below)]:
+                    del pending[other]
+                scanroot = max(x for x in scanroots
+                               if dirpath == x or
+                               dirpath.startswith(x + os.sep))
+                scanroots[scanroot].scan(dirpath)
+    finally:
+        inotify.close()
@@ -47,6 +47,7 @@ setup(name='marv-robotics',
       packages=['marv_robotics', 'marv_robotics.tests'],
       include_package_data=True,
       zip_safe=False,
+      entry_points={'marv_cli': ['marv_robotics = marv_robotics.cli']},
       test_suite='nose.collector',
       tests_require=['nose'],
       install_requires=['marv',